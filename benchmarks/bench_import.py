@@ -0,0 +1,104 @@
+"""Benchmark the import time and memory of the package entry points.
+
+Every scenario runs in a fresh interpreter, so nothing is cached in
+sys.modules, and reports the median import time, the peak RSS of the process
+and which heavy dependencies got loaded.  The "eager" scenario imports every
+backend up front, as the package did before they were loaded lazily, to show
+the gain of the numpy-only reader path.
+
+Usage: python benchmarks/bench_import.py [--repeat 10] [--output results.json]
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+
+HEAVY_MODULES = ("h5py", "dicom", "PIL", "asyncio", "multiprocessing")
+
+SCENARIOS = [
+    ("python", "pass"),
+    ("numpy", "import numpy"),
+    ("package", "import contours_processor"),
+    ("npy_reader", "from contours_processor import ContourDataset\n"
+                   "from contours_processor.stores import NpyDatasetReader"),
+    ("hdf5_reader", "from contours_processor import ContourDataset\n"
+                    "from contours_processor.stores import PackedDatasetReader\n"
+                    "import h5py"),
+    ("extractor", "from contours_processor import ContourFileExtractor"),
+    ("eager", "import h5py, dicom\n"
+              "from PIL import Image, ImageDraw\n"
+              "from contours_processor import ContourFileExtractor, ContourDataset\n"
+              "from contours_processor import aio, validation, segmentation"),
+]
+
+# Run in the child interpreter: time the snippet and report what it loaded
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+error = None
+try:
+    exec(compile({code!r}, "<scenario>", "exec"))
+except ImportError as e:
+    error = str(e)
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"seconds": elapsed, "error": error, "loaded": heavy,
+    "n_modules": len(sys.modules),
+    "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}}))
+"""
+
+
+def run_scenario(code):
+    """Run code in a fresh interpreter and return its measurements"""
+    probe = PROBE.format(code=code, heavy=HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, "-c", probe])
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def bench_scenario(name, code, repeat):
+    runs = [run_scenario(code) for _ in range(repeat)]
+    last = runs[-1]
+    return {
+        "scenario": name,
+        "import_ms": 1000 * median([run["seconds"] for run in runs]),
+        "max_rss_kb": median([run["max_rss_kb"] for run in runs]),
+        "n_modules": last["n_modules"],
+        "loaded": last["loaded"],
+        "error": last["error"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--scenarios", nargs="+", choices=[name for name, _ in SCENARIOS],
+        help="Scenarios to run.  Default to all")
+    parser.add_argument("--output", help="JSON results file.  Default to stdout")
+    args = parser.parse_args()
+
+    results = [bench_scenario(name, code, args.repeat) for name, code in SCENARIOS
+               if not args.scenarios or name in args.scenarios]
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Benchmark extraction and batch generation throughput.
+
+Generates synthetic DICOMs and contour files in the layout ContourFileExtractor
+expects, then times the hot paths of the pipeline at several dataset sizes,
+batch sizes and target sizes.  Every result is reported as slices/sec and peak
+traced memory, written as JSON so runs can be compared across releases.
+
+Usage: python benchmarks/bench_pipeline.py [--n-slices 20 100] [--batch-sizes 8 32]
+    [--target-sizes 128 256] [--extract-workers 4] [--output results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from dicom.dataset import Dataset, FileDataset
+
+from contours_processor import ContourFileExtractor, ContourDataset
+from contours_processor.utils import dump_dataset, load_dataset
+
+N_PATIENTS = 2
+IMAGE_SIZE = 256
+
+
+def patient_folders(patient_idx):
+    """Return the (contour folder, dicom folder) names of a synthetic patient"""
+    return "SC-HF-I-{}".format(patient_idx + 1), "SCD{:05d}01".format(patient_idx + 1)
+
+
+def write_dicom(filename, pixels):
+    """Write a minimal MR DICOM file with 16 bit unsigned pixels"""
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+    file_meta.MediaStorageSOPInstanceUID = "1.2.826.0.1.3680043.2.1125.{}".format(
+        abs(hash(filename)))
+    file_meta.ImplementationClassUID = "1.2.826.0.1.3680043.2.1125.1"
+    file_meta.TransferSyntaxUID = "1.2.840.10008.1.2.1"  # Explicit VR Little Endian
+
+    dcm = FileDataset(filename, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    dcm.is_little_endian = True
+    dcm.is_implicit_VR = False
+    dcm.Rows, dcm.Columns = pixels.shape
+    dcm.SamplesPerPixel = 1
+    dcm.PhotometricInterpretation = "MONOCHROME2"
+    dcm.BitsAllocated = 16
+    dcm.BitsStored = 16
+    dcm.HighBit = 15
+    dcm.PixelRepresentation = 0
+    dcm.RescaleIntercept = -1024
+    dcm.RescaleSlope = 1
+    dcm.PixelData = pixels.astype(np.uint16).tobytes()
+    dcm.save_as(filename)
+
+
+def write_contour(filename, center, radius, n_points, rng):
+    angles = np.linspace(0, 2 * np.pi, n_points, endpoint=False)
+    radii = radius * rng.uniform(0.9, 1.1, n_points)
+    coords = np.stack([center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)], 1)
+    np.savetxt(filename, coords, fmt="%.2f")
+
+
+def make_dataset(root, n_slices, n_points=120, seed=1234):
+    """Write n_slices DICOMs with o-contours and i-contours split between N_PATIENTS patients
+
+    :return: contour folder -> dicom folder map
+    """
+    rng = np.random.RandomState(seed)
+    folder_map = {}
+    for slice_idx in range(n_slices):
+        patient_idx = slice_idx % N_PATIENTS
+        contour_folder, dicom_folder = patient_folders(patient_idx)
+        folder_map[contour_folder] = dicom_folder
+        slice_number = slice_idx // N_PATIENTS + 1
+
+        dicom_path = os.path.join(root, "dicoms", dicom_folder)
+        if not os.path.isdir(dicom_path):
+            os.makedirs(dicom_path)
+        pixels = rng.randint(0, 2000, size=(IMAGE_SIZE, IMAGE_SIZE))
+        write_dicom(os.path.join(dicom_path, "{}.dcm".format(slice_number)), pixels)
+
+        center = rng.uniform(0.4, 0.6, 2) * IMAGE_SIZE
+        for contour_type, tag, radius in (("o-contours", "ocontour", 40), ("i-contours", "icontour", 25)):
+            contour_path = os.path.join(root, "contourfiles", contour_folder, contour_type)
+            if not os.path.isdir(contour_path):
+                os.makedirs(contour_path)
+            filename = "IM-0001-{:04d}-{}-manual.txt".format(slice_number, tag)
+            write_contour(os.path.join(contour_path, filename), center, radius, n_points, rng)
+    return folder_map
+
+
+def measure(func, n_slices, repeat):
+    """Return (slices/sec of the best of repeat runs, peak traced memory of one run)"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return n_slices / best, peak
+
+
+def run_case(results, name, func, n_slices, repeat, **params):
+    slices_per_sec, peak = measure(func, n_slices, repeat)
+    result = dict(benchmark=name, n_slices=n_slices, slices_per_sec=slices_per_sec,
+        peak_memory_bytes=peak, **params)
+    results.append(result)
+    print("{:<20} {:<40} {:>10.1f} slices/s {:>10.1f} MiB".format(
+        name, ", ".join("{}={}".format(key, value) for key, value in sorted(params.items())),
+        slices_per_sec, peak / 2 ** 20))
+
+
+def bench_size(results, root, n_slices, target_sizes, batch_sizes, repeat, extract_workers):
+    folder_map = make_dataset(root, n_slices)
+    for target in target_sizes:
+        extractor = ContourFileExtractor("contourfiles/", "dicoms/",
+            secondary_contours=["i-contours"], target_size=(target, target),
+            contour_dicom_folder_map=folder_map, on_error_action="skip")
+        contour_files = extractor._get_contour_files(shuffle=False)
+        dicom_files = [extractor._dicom_filepath_extractor(extractor._dicom_root, contour_file,
+            folder_map) for contour_file in contour_files]
+        samples = [datasets for datasets, _ in extractor.datasets_generator()]
+
+        run_case(results, "parse_dicom_file",
+            lambda: [extractor._parse_dicom_file(filename) for filename in dicom_files],
+            n_slices, repeat, target_size=target)
+        run_case(results, "parse_contour_file",
+            lambda: [extractor._parse_contour_file(filename) for filename in contour_files],
+            n_slices, repeat, target_size=target)
+        run_case(results, "dataset_validator",
+            lambda: [extractor._dataset_validator(datasets) for datasets in samples],
+            n_slices, repeat, target_size=target)
+        run_case(results, "datasets_generator",
+            lambda: list(extractor.datasets_generator()),
+            n_slices, repeat, target_size=target)
+        # Threads only overlap I/O, decoding in processes sidesteps the GIL
+        for workers in sorted({1, extract_workers}):
+            run_case(results, "pipeline_generator",
+                lambda: list(extractor.pipeline_generator(extract_workers=workers)),
+                n_slices, repeat, target_size=target, extract_workers=workers, executor="thread")
+        # Includes starting the worker processes, which receive the extractor once
+        run_case(results, "pipeline_generator",
+            lambda: list(extractor.pipeline_generator(extract_workers=2 * extract_workers,
+                extract_processes=extract_workers)),
+            n_slices, repeat, target_size=target, extract_workers=extract_workers,
+            executor="process")
+
+        h5_folder = os.path.join(root, "h5-{}".format(target))
+        os.makedirs(h5_folder)
+        h5_files = [os.path.join(h5_folder, "{}.h5".format(idx)) for idx in range(len(samples))]
+        run_case(results, "dump_dataset",
+            lambda: [dump_dataset(filename, datasets) for filename, datasets in zip(h5_files, samples)],
+            n_slices, repeat, target_size=target)
+        run_case(results, "load_dataset",
+            lambda: [load_dataset(filename) for filename in h5_files],
+            n_slices, repeat, target_size=target)
+
+        for batch_size in batch_sizes:
+            dataset = ContourDataset("dicom", "o-contours", contour_dicom_folder=h5_folder,
+                target_size=(target, target))
+            run_case(results, "generate_batch",
+                lambda: list(dataset.generate_batch(batch_size=batch_size)),
+                n_slices, repeat, target_size=target, batch_size=batch_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n-slices", type=int, nargs="+", default=[20, 100])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--target-sizes", type=int, nargs="+", default=[128, 256])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--extract-workers", type=int, default=4,
+        help="Workers of the pipeline_generator extract stage")
+    parser.add_argument("--output", help="JSON results file.  Default to stdout")
+    args = parser.parse_args()
+
+    results = []
+    cwd = os.getcwd()
+    for n_slices in args.n_slices:
+        root = tempfile.mkdtemp()
+        try:
+            # The extractor expects contour paths relative to the working directory
+            os.chdir(root)
+            bench_size(results, root, n_slices, args.target_sizes, args.batch_sizes, args.repeat,
+                args.extract_workers)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(root)
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
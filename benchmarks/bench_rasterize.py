@@ -0,0 +1,96 @@
+"""Benchmark contour parsing and rasterisation.
+
+Compares the original per-line parsing + PIL drawing + np.array().astype(bool)
+with ContourFileExtractor._parse_contour_files (bulk NumPy parsing, PIL drawing
+viewed as bool with a single copy), and checks that every mask matches pixel
+for pixel.
+
+Usage: python benchmarks/bench_rasterize.py [--n-contours 200] [--n-points 150]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from contours_processor import ContourFileExtractor
+
+
+def make_contour_files(folder, n_contours, n_points, target_size, seed=1234):
+    rng = np.random.RandomState(seed)
+    filenames = []
+    for idx in range(n_contours):
+        center = rng.uniform(0.35, 0.65, 2) * target_size
+        radius = rng.uniform(0.05, 0.2) * min(target_size)
+        angles = np.linspace(0, 2 * np.pi, n_points, endpoint=False)
+        radii = radius * rng.uniform(0.85, 1.15, n_points)
+        filename = os.path.join(folder, "IM-0001-{:04d}-ocontour-manual.txt".format(idx))
+        with open(filename, "w") as f:
+            for angle, r in zip(angles, radii):
+                f.write("{:.2f} {:.2f}\n".format(center[0] + r * np.cos(angle),
+                    center[1] + r * np.sin(angle)))
+        filenames.append(filename)
+    return filenames
+
+
+def baseline_parse_contour_file(filename, target_size):
+    """The original _parse_contour_file implementation"""
+    coords_lst = []
+    with open(filename, 'r') as infile:
+        for line in infile:
+            coords = line.strip().split()
+            coords_lst.append((float(coords[0]), float(coords[1])))
+    img = Image.new(mode='L', size=target_size, color=0)
+    ImageDraw.Draw(img).polygon(xy=coords_lst, outline=0, fill=1)
+    return np.array(img).astype(bool)
+
+
+def best_time(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n-contours", type=int, default=200)
+    parser.add_argument("--n-points", type=int, default=150)
+    parser.add_argument("--target-size", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    target_size = (args.target_size, args.target_size)
+    folder = tempfile.mkdtemp()
+    try:
+        filenames = make_contour_files(folder, args.n_contours, args.n_points, target_size)
+        baseline_time, expected = best_time(lambda: np.stack(
+            [baseline_parse_contour_file(filename, target_size) for filename in filenames]),
+            args.repeat)
+        print("{:<28} {:>10.1f} us/contour".format("baseline", baseline_time / len(filenames) * 1e6))
+
+        extractor = ContourFileExtractor(folder, folder, target_size=target_size)
+        # One slice holds one primary and one secondary contour
+        pairs = [filenames[idx:idx + 2] for idx in range(0, len(filenames), 2)]
+        elapsed, masks = best_time(lambda: np.concatenate(
+            [extractor._parse_contour_files(pair)[0] for pair in pairs]), args.repeat)
+        assert (masks == expected).all(), "masks differ from the baseline"
+        print("{:<28} {:>10.1f} us/contour  ({:.2f}x)".format("2 contours per call",
+            elapsed / len(filenames) * 1e6, baseline_time / elapsed))
+
+        elapsed, (masks, _) = best_time(lambda: extractor._parse_contour_files(filenames),
+            args.repeat)
+        assert (masks == expected).all(), "masks differ from the baseline"
+        print("{:<28} {:>10.1f} us/contour  ({:.2f}x)".format("all contours per call",
+            elapsed / len(filenames) * 1e6, baseline_time / elapsed))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,30 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division
 import logging
+from importlib import import_module
 
 logger = logging.getLogger('contours_processor')
 
-from .file_extractors import ContourFileExtractor  # noqa
-from .datasets import ContourDataset  # noqa
+# Public classes are imported from their module on first access, so importing the
+# package doesn't load h5py, dicom or PIL until a class needing them is used
+_LAZY_ATTRIBUTES = {
+    "ContourFileExtractor": ".file_extractors",
+    "ContourDataset": ".datasets",
+    "DicomCache": ".cache",
+    "ContourFileIndex": ".index",
+    "PipelineStats": ".stats",
+}
+
+__all__ = ["logger"] + sorted(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
@@ -0,0 +1,123 @@
+import asyncio
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _read_bytes(filename):
+    """Return the content of filename, None if it can't be read"""
+    if filename is None:
+        return None
+    try:
+        with open(filename, "rb") as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+async def _fetch_inputs(extractor, contour_path, semaphore, io_executor):
+    """Resolve and read the dicom and contour files of contour_path concurrently
+
+    :return: The inputs (see ContourFileExtractor._contour_file_inputs) and the
+        dictionary of filepath -> file content
+    """
+    loop = asyncio.get_event_loop()
+    async with semaphore:
+        inputs = await loop.run_in_executor(io_executor, extractor._contour_file_inputs,
+            contour_path)
+        paths = [path for path in inputs.values() if path is not None]
+        contents = await asyncio.gather(*[loop.run_in_executor(io_executor, _read_bytes, path)
+            for path in paths])
+    file_bytes = {path: content for path, content in zip(paths, contents) if content is not None}
+    return inputs, file_bytes
+
+
+async def _process(func, extractor, contour_path, semaphore, io_executor, executor):
+    """Fetch the input files then run func(contour_path, file_bytes, inputs) in the executor
+
+    The inputs resolved while fetching are passed on so they aren't resolved again.
+    """
+    inputs, file_bytes = await _fetch_inputs(extractor, contour_path, semaphore, io_executor)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, func, contour_path, file_bytes, inputs)
+
+
+async def map_contour_files(extractor, func, contour_files, concurrency=16, executor=None,
+        ordered=True):
+    """Async generator of func(contour_path, file_bytes, inputs) for each contour file
+
+    The files of up to `concurrency` contour files are read at once by a pool of
+    `concurrency` I/O threads, and func (the CPU bound decode) runs in executor.
+
+    :param executor: concurrent.futures Executor for func.  Default to None (the
+        event loop default executor)
+    :param ordered: When False, yield the results as soon as they are ready
+    """
+    io_executor = ThreadPoolExecutor(max_workers=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    contour_files = iter(contour_files)
+    # Bound the number of contour files in flight, fetched or being decoded
+    max_pending = 2 * concurrency
+    pending = deque()
+
+    def schedule():
+        for contour_path in contour_files:
+            pending.append(asyncio.ensure_future(_process(func, extractor, contour_path,
+                semaphore, io_executor, executor)))
+            if len(pending) >= max_pending:
+                break
+
+    try:
+        schedule()
+        while pending:
+            if ordered:
+                task = pending.popleft()
+                await asyncio.wait([task])
+            else:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                task = next(iter(done))
+                pending.remove(task)
+            schedule()
+            yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        io_executor.shutdown(wait=False)
+
+
+async def datasets_generator(extractor, shuffle=False, concurrency=16, executor=None, ordered=True):
+    """Async iterator of the valid (datasets, sources) of the extractor
+
+    See map_contour_files for concurrency, executor and ordered.
+    """
+    contour_files = extractor._get_contour_files(shuffle)
+    results = map_contour_files(extractor, extractor._extract_valid_contour_file, contour_files,
+        concurrency, executor, ordered)
+    try:
+        async for status, datasets, sources in results:
+            if status == "saved":
+                yield datasets, sources
+    finally:
+        await results.aclose()
+
+
+async def save_datasets(extractor, output_dir, n_samples=None, shuffle=False, concurrency=16,
+        executor=None):
+    """Save the HDF5 files of the extractor, reading the input files concurrently
+
+    :return: Dictionary with the count of "saved", "skipped" and "failed" files
+    """
+    contour_files = extractor._get_contour_files(shuffle)
+    if n_samples:
+        contour_files = contour_files[:n_samples]
+
+    summary = {"saved": 0, "skipped": 0, "failed": 0}
+    statuses = map_contour_files(extractor, partial(extractor._save_contour_file, output_dir),
+        contour_files, concurrency, executor, ordered=False)
+    try:
+        async for status in statuses:
+            summary[status] += 1
+            extractor.stats.incr("files_{}".format(status))
+    finally:
+        await statuses.aclose()
+    return summary
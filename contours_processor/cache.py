@@ -0,0 +1,155 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class DicomCache(object):
+    """Cache of parsed DICOM pixel arrays keyed by file path, mtime and size.
+
+    Arrays are kept in a memory LRU bounded by max_bytes and, when cache_dir is
+    set, also saved as .npy files so they survive across runs and are shared by
+    worker processes.  Cached arrays are returned read-only.
+
+    Other kinds of arrays derived from the file (ex: its rescale) can be kept
+    next to the pixels by passing a kind to get.
+
+    hits, disk_hits and misses count the pixel lookups served from memory, from
+    disk and by parsing the file.  The extractors merge back the counts of the copies
+    sent to their worker processes.
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # Worker processes start with an empty memory tier, the disk tier is shared
+        state = self.__dict__.copy()
+        state["_entries"] = OrderedDict()
+        state["_nbytes"] = 0
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _key(self, filename, kind=None):
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+        return key if kind is None else key + (kind,)
+
+    def _disk_path(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "{}.npy".format(digest))
+
+    def _insert(self, key, data):
+        if data.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = data
+            self._nbytes += data.nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+
+    def _load_disk(self, key):
+        disk_path = self._disk_path(key)
+        if not os.path.isfile(disk_path):
+            return None
+        try:
+            return np.load(disk_path)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save_disk(self, key, data):
+        disk_path = self._disk_path(key)
+        tmp_path = "{}.{}.tmp".format(disk_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp_path, disk_path)
+
+    def get(self, filename, loader, kind=None):
+        """Return the cached array for filename, calling loader(filename) on a miss
+
+        Files that can't be stat-ed and loader results of None are not cached.
+
+        :param kind: Name of an array derived from the file, cached next to its pixels
+            and not counted in the stats.  Default to None (the pixels)
+        """
+        try:
+            key = self._key(filename, kind)
+        except (TypeError, OSError):
+            return loader(filename)
+
+        counted = kind is None
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += counted
+                return data
+
+        if self.cache_dir:
+            data = self._load_disk(key)
+            if data is not None:
+                data.flags.writeable = False
+                self._insert(key, data)
+                with self._lock:
+                    self.disk_hits += counted
+                return data
+
+        data = loader(filename)
+        with self._lock:
+            self.misses += counted
+        if data is None:
+            return None
+        data = np.asarray(data)
+        data.flags.writeable = False
+        self._insert(key, data)
+        if self.cache_dir:
+            self._save_disk(key, data)
+        return data
+
+    def counters(self):
+        """Return the (hits, disk_hits, misses) counters"""
+        with self._lock:
+            return self.hits, self.disk_hits, self.misses
+
+    def merge_counters(self, counters):
+        """Add (hits, disk_hits, misses) counted by another copy (ex: in a worker process)"""
+        hits, disk_hits, misses = counters
+        with self._lock:
+            self.hits += hits
+            self.disk_hits += disk_hits
+            self.misses += misses
+
+    def stats(self):
+        """Return dictionary of hits, disk_hits, misses, entries and bytes in memory"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._nbytes,
+            }
+
+    def clear(self):
+        """Empty the memory tier and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self.hits = self.disk_hits = self.misses = 0
@@ -1,11 +1,58 @@
 import os.path
+import time
 from pickle import UnpicklingError
 from glob import glob
+from itertools import islice
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 from . import logger
-from .utils import load_dataset
+from .utils import load_dataset, _padded_shard
 from .exceptions import InvalidDatasetError
+from .prefetch import BackgroundGenerator, ordered_map
+from .stores import open_store
+from .transforms import BatchTransform
+from .stats import NullStats
+from .features import get_channel, add_derived_channels
+
+
+class _BatchBuffers(object):
+    """Ring of preallocated batch arrays reused across batches.
+
+    With a ring size of 0 fresh arrays are allocated for every batch.
+    """
+
+    def __init__(self, batch_size, ring_size=0):
+        self._batch_size = batch_size
+        self._ring = [None] * ring_size
+        self._ring_idx = 0
+
+    def get(self, sample_shape, dtype):
+        """Return a (batch_size, *sample_shape) array of dtype"""
+        shape = (self._batch_size,) + tuple(sample_shape)
+        if not self._ring:
+            return np.empty(shape, dtype=dtype)
+        buffer = self._ring[self._ring_idx]
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._ring[self._ring_idx] = buffer
+        self._ring_idx = (self._ring_idx + 1) % len(self._ring)
+        return buffer
+
+
+def _shuffle_buffer(iterable, buffer_size, rng):
+    """Yield the items of iterable shuffled within a window of buffer_size items"""
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        idx = rng.randint(buffer_size)
+        yield buffer[idx]
+        buffer[idx] = item
+    for idx in rng.permutation(len(buffer)):
+        yield buffer[idx]
 
 
 class ContourDataset(object):
@@ -17,29 +64,110 @@ class ContourDataset(object):
             include_sources=False,
             contour_dicom_generator=None,
             contour_dicom_folder=None,
+            contour_dicom_store=None,
             on_error_action="raise",
+            x_dtype=None,
+            y_dtype=None,
             target_size=(224, 224),
             padding=0,
-            crop_mode="center"):  # center or random cropping
-        """Create a Dataset with given parameters"""
-        if contour_dicom_folder and contour_dicom_generator:
-            raise InvalidDatasetError("Please specify only the folder for files or the generator object")
-        if contour_dicom_folder is None and contour_dicom_generator is None:
-            raise InvalidDatasetError("Both the folder for files and the generator object can't be None")
+            crop_mode="center",  # center or random cropping
+            num_shards=1,
+            shard_index=0,
+            seed=None,
+            shuffle_buffer=0,
+            stats=None):
+        """Create a Dataset with given parameters
+
+        Samples come from exactly one of contour_dicom_generator, contour_dicom_folder
+        (one HDF5 file per sample) or contour_dicom_store (packed HDF5 file, glob
+        pattern or list of shards written with output_format="packed", or a folder
+        written with output_format="npy" which is read through np.memmap).
+
+        x_dtype / y_dtype set the dtype of the generated batches (ex: np.float32 for
+        the Dicoms and np.uint8 for the masks).  When None, the dtype is promoted
+        over the channels of all the samples in the batch (as np.array would).
+
+        num_shards / shard_index split the samples between data parallel workers:
+        each epoch the samples are ordered (shuffled with seed + epoch, see set_epoch)
+        and shard_index gets every num_shards-th sample.  The last samples are padded
+        by wrapping around to the first ones, so every shard has the same length, and
+        the shards are reproducible.  All the shards must use the same seed when
+        shuffling.  Generator samples can't be reordered up front, they are shuffled
+        within a buffer of shuffle_buffer samples instead, and every shard reads the
+        whole generator (their lengths can differ by one): shard the generators of
+        ContourFileExtractor with their num_shards / shard_index instead.
+
+        target_size (width, height), padding and crop_mode ("center", "random" or
+        "resize") are applied to whole batches, see transforms.BatchTransform.  Masks
+        (bool channels and the y channels) are resized with nearest neighbour
+        sampling.  Set target_size to None to keep the samples as stored.
+
+        stats is an optional PipelineStats collecting the load, transform and
+        queue_wait (time spent waiting on prefetched batches) timings and the
+        samples, batches and sample_errors counters.  Default to NullStats.
+
+        x_channels and y_channels can name registered derived channels (see features).
+        Samples saved without them (or with another version) compute them from their
+        input channels.
+        """
+        n_inputs = sum(1 for contour_input in (contour_dicom_folder, contour_dicom_generator,
+            contour_dicom_store) if contour_input is not None)
+        if n_inputs > 1:
+            raise InvalidDatasetError("Please specify only the folder for files, the store or the generator object")
+        if n_inputs == 0:
+            raise InvalidDatasetError("The folder for files, the store and the generator object can't all be None")
+        if not 0 <= shard_index < num_shards:
+            raise InvalidDatasetError("shard_index must be between 0 and num_shards - 1")
 
         self.x_channels = x_channels
         self.y_channels = y_channels
         self._include_sources = include_sources
         self._contour_dicom_folder = contour_dicom_folder
         self._contour_dicom_generator = contour_dicom_generator
+        self._contour_dicom_store = None
+        if contour_dicom_store is not None:
+            self._contour_dicom_store = open_store(contour_dicom_store)
         self._on_error_action = on_error_action
-        # TODO: Resize, Padding and Cropping in generated Batches
+        self.x_dtype = x_dtype
+        self.y_dtype = y_dtype
         self._target_size = target_size
         self._padding = padding
-        self._crop_mode = "center"
+        self._crop_mode = crop_mode
+        self._transform = None
+        if target_size is not None:
+            self._transform = BatchTransform(target_size, padding, crop_mode)
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.seed = seed
+        self.shuffle_buffer = shuffle_buffer
+        self.epoch = 0
+        self.stats = stats if stats is not None else NullStats()
+        self._derived_channels = [channel for channel in self._channel_list()
+            if get_channel(channel) is not None]
+
+    def set_epoch(self, epoch):
+        """Set the epoch used with the seed to shuffle the samples"""
+        self.epoch = epoch
+
+    def _random_state(self):
+        """Return the random state of the current epoch (np.random when no seed is set)"""
+        if self.seed is None:
+            return np.random
+        return np.random.RandomState(self.seed + self.epoch)
+
+    def _shard_indices(self, n_samples, shuffle):
+        """Return this shard's indices of n_samples for the current epoch"""
+        if shuffle:
+            if self.num_shards > 1 and self.seed is None:
+                raise ValueError("A seed is required to shuffle sharded datasets")
+            indices = self._random_state().permutation(n_samples)
+        else:
+            indices = np.arange(n_samples)
+        return _padded_shard(indices, self.num_shards, self.shard_index)
 
     def _log_error(self, err_msg):
         """Raise Exception if action is set otherwise log as warnings"""
+        self.stats.incr("sample_errors")
         if self._on_error_action == "raise":
             raise InvalidDatasetError(err_msg)
         else:
@@ -48,10 +176,92 @@ class ContourDataset(object):
     def _contour_folder_gen(self, contour_files):
 
         for contour_file in contour_files:
-            try:
-                yield load_dataset(contour_file)
-            except (FileNotFoundError, UnpicklingError) as e:
-                raise InvalidDatasetError("{} - File IO Error".format(contour_file))
+            yield self._load_contour_file(contour_file)
+
+    def _load_contour_file(self, contour_file):
+        try:
+            with self.stats.timer("load"):
+                return self._load_channels(contour_file)
+        except (FileNotFoundError, UnpicklingError) as e:
+            raise InvalidDatasetError("{} - File IO Error".format(contour_file))
+
+    def _timed_load_dataset(self, contour_file):
+        with self.stats.timer("load"):
+            return self._load_channels(contour_file)
+
+    def _load_channels(self, contour_file):
+        """Load only the x and y channels, none when the file metadata lacks one of them"""
+        return load_dataset(contour_file, channels=self._read_channel_list(),
+            require_all=not self._derived_channels)
+
+    def _channel_list(self):
+        """Return the list of all x and y channels"""
+        channels = []
+        for channel in (self.x_channels, self.y_channels):
+            if type(channel) == str:
+                channels.append(channel)
+            elif channel is not None:
+                channels.extend(channel)
+        return channels
+
+    def _read_channel_list(self):
+        """Return the channels to read: the x and y channels and the inputs of the derived ones"""
+        channels = self._channel_list()
+        for name in self._derived_channels:
+            channels.extend(key for key in get_channel(name).inputs if key not in channels)
+        return channels
+
+    def _contour_store_gen(self, indices, read_size):
+        """Yield (dataset, sources) reading read_size samples at a time from the store"""
+        store = self._contour_dicom_store
+        channels = self._read_channel_list()
+        for start in range(0, len(indices), read_size):
+            block_indices = indices[start:start + read_size]
+            with self.stats.timer("load"):
+                datasets, present = store.read(block_indices, channels)
+                if self._include_sources:
+                    sources_block = store.sources(block_indices)
+                elif self._derived_channels:
+                    # The stored derived channel versions tell which ones are stale
+                    sources_block = [dict({key: sources[key] for key in self._derived_channels
+                        if key in sources}, filename=sources["filename"])
+                        for sources in store.sources(block_indices)]
+                else:
+                    sources_block = [{"filename": store.sample_name(idx)} for idx in block_indices]
+            for block_idx, sources in enumerate(sources_block):
+                dataset = {key: data[block_idx] for key, data in datasets.items()
+                    if present[key][block_idx]}
+                yield dataset, sources
+
+    def _contours_generator(self, shuffle, executor=None, window=1, read_size=64):
+        """Return generator of (dataset, sources) from the folder, store or the generator object
+
+        When an executor is given, the files are loaded concurrently keeping
+        `window` files in flight.  Store samples are read read_size at a time.
+        """
+        if self._contour_dicom_store is not None:
+            indices = self._shard_indices(len(self._contour_dicom_store), shuffle)
+            return self._contour_store_gen(indices, read_size)
+        if not self._contour_dicom_folder:
+            contours_generator = self._contour_dicom_generator
+            if self.num_shards > 1:
+                contours_generator = islice(contours_generator, self.shard_index, None,
+                    self.num_shards)
+            if shuffle and self.shuffle_buffer:
+                contours_generator = _shuffle_buffer(contours_generator, self.shuffle_buffer,
+                    self._random_state())
+            return contours_generator
+
+        # Sorted so every shard starts from the same order
+        contour_files = sorted(glob(os.path.join(self._contour_dicom_folder, "*.h5")))
+        contour_files = [contour_files[idx] for idx in self._shard_indices(len(contour_files), shuffle)]
+        if executor is not None:
+            load_func = partial(load_dataset, channels=self._read_channel_list(),
+                require_all=not self._derived_channels)
+            if self.stats.enabled and isinstance(executor, ThreadPoolExecutor):
+                load_func = self._timed_load_dataset
+            return ordered_map(load_func, contour_files, executor, window)
+        return self._contour_folder_gen(contour_files)
 
     def _parse_channels(self, dataset, channels):
         """Extract channels from dataset.  Raise error if channel data not found
@@ -73,44 +283,224 @@ class ContourDataset(object):
                     raise ValueError
         return data
 
-    def generate_batch(self, batch_size=8, shuffle=True):
-        """Return batch of Dicoms and Contours
+    def _fill_sample(self, batch, idx, data):
+        """Copy the channel data of one sample in place into the batch array"""
+        if type(data) == list:
+            for channel_idx, channel_data in enumerate(data):
+                batch[idx, channel_idx] = channel_data
+        else:
+            batch[idx] = data
 
-        :param batch_size: Length of each batch.  Default to 8
-        :param shuffle: When True, randomly shuffled batch data
-        :return: Numpy Array with shape (batch_size, width, height)
+    def _sample_layout(self, data, dtype):
+        """Return the (shape, dtype) of a sample's channel data"""
+        if type(data) == list:
+            shape = (len(data),) + data[0].shape
+            arrays = data
+        else:
+            shape = data.shape
+            arrays = [data]
+        if dtype is None:
+            dtype = np.result_type(*arrays)
+        return shape, dtype
+
+    def _promoted_batch(self, batch, n_filled, data):
+        """Return batch, copied to a wider dtype when data can't be cast to it losslessly"""
+        dtype = self._sample_layout(data, None)[1]
+        if np.can_cast(dtype, batch.dtype, "safe"):
+            return batch
+        promoted = np.empty(batch.shape, dtype=np.result_type(batch.dtype, dtype))
+        promoted[:n_filled] = batch[:n_filled]
+        return promoted
+
+    def _stack_transformed(self, samples, buffers, dtype, offsets, nearest):
+        """Transform the samples into a batch array from buffers
+
+        Crops are written straight into the batch array, resized samples are
+        stacked and resized by groups of the same shape.
+
+        :param samples: List of channel data, all with the same channel count
+        :param offsets: (n, 2) crop offsets of the samples
+        :param nearest: Per channel (or single) flag for nearest neighbour resizing
         """
-        if self._contour_dicom_folder:
-            contour_files = glob(os.path.join(self._contour_dicom_folder, "*.h5"))
-            if shuffle:
-                contour_files = np.random.permutation(contour_files)
-            contours_generator = self._contour_folder_gen(contour_files)
+        interpolated = self._crop_mode == "resize" and not np.all(nearest)
+        if dtype is None:
+            # Promote over the whole batch, the samples don't all have the same dtype
+            dtype = np.result_type(*[self._sample_layout(data, None)[1] for data in samples])
+            if interpolated:
+                # Bilinear resizing returns float32, don't truncate it to the stored dtype
+                dtype = np.result_type(dtype, np.float32)
+        shape, dtype = self._sample_layout(samples[0], dtype)
+        batch = buffers.get(self._transform.output_shape(shape), dtype)
+        if self._crop_mode != "resize":
+            for idx, data in enumerate(samples):
+                if type(data) == list:
+                    for channel_idx, channel_data in enumerate(data):
+                        self._transform.crop_into(batch[idx, channel_idx], channel_data,
+                            offsets[idx])
+                else:
+                    self._transform.crop_into(batch[idx], data, offsets[idx])
+            return batch
+        groups = {}
+        for idx, data in enumerate(samples):
+            groups.setdefault(self._sample_layout(data, None)[0], []).append(idx)
+        for idxs in groups.values():
+            group = np.array([samples[idx] for idx in idxs])
+            if self._crop_mode == "resize" and np.any(nearest) and not np.all(nearest):
+                transformed = self._transform(group, offsets[idxs], nearest=False)
+                transformed[:, nearest] = self._transform(group[:, nearest], offsets[idxs])
+            else:
+                transformed = self._transform(group, offsets[idxs], nearest=np.all(nearest))
+            batch[idxs] = transformed
+        return batch
+
+    def _transform_batch(self, x_samples, y_samples, x_buffers, y_buffers, rng):
+        """Return the (x_batch, y_batch) of the samples transformed to the target size"""
+        offsets = self._transform.crop_offsets(len(x_samples), rng)
+        if type(x_samples[0]) == list:
+            x_nearest = np.array([channel.dtype == bool for channel in x_samples[0]])
         else:
-            contours_generator = self._contour_dicom_generator
+            x_nearest = x_samples[0].dtype == bool
+        x_batch = self._stack_transformed(x_samples, x_buffers, self.x_dtype, offsets, x_nearest)
+        y_batch = self._stack_transformed(y_samples, y_buffers, self.y_dtype, offsets, True)
+        return x_batch, y_batch
+
+    def _valid_layout(self, data, layout):
+        """Return True if the channels of data have the same shape and channel count as layout"""
+        if type(data) == list:
+            if any(channel.shape != data[0].shape for channel in data):
+                return False
+            shape = (len(data),) + data[0].shape
+        else:
+            shape = data.shape
+        return layout is None or len(shape) == len(layout) and shape[:-2] == layout[:-2]
+
+    def _make_batch(self, sources_batch, x_batch, y_batch):
+        if self._include_sources:
+            return sources_batch, x_batch, y_batch
+        return x_batch, y_batch
 
-        x_batch, y_batch, sources_batch = [], [], []
+    def _batch_generator(self, contours_generator, batch_size, reuse_buffers=0):
+        x_buffers = _BatchBuffers(batch_size, reuse_buffers)
+        y_buffers = _BatchBuffers(batch_size, reuse_buffers)
+        x_batch, y_batch, sources_batch = None, None, []
+        x_samples, y_samples = [], []
+        rng = self._random_state()
         batch_idx = 0
-        for idx, (dataset, sources) in enumerate(contours_generator):
-            if batch_idx > 0 and batch_idx % batch_size == 0:
-                if self._include_sources:
-                    yield sources_batch, np.array(x_batch), np.array(y_batch)
-                else:
-                    yield np.array(x_batch), np.array(y_batch)
-                x_batch, y_batch, sources_batch = [], [], []
-                batch_idx = 0
+        n_batches = 0
+        for dataset, sources in contours_generator:
+            if self._derived_channels:
+                add_derived_channels(self._derived_channels, dataset, sources)
             try:
                 x_data = self._parse_channels(dataset, self.x_channels)
                 y_data = self._parse_channels(dataset, self.y_channels)
-                x_batch.append(x_data)
-                y_batch.append(y_data)
-                sources_batch.append(sources)
-                batch_idx += 1
             except ValueError:
                 # Log Error
                 err_msg = "Missing all channels in {}".format(sources["filename"])
                 self._log_error(err_msg)
+                continue
 
-        if self._include_sources:
-            yield sources_batch, np.array(x_batch), np.array(y_batch)
-        else:
-            yield np.array(x_batch), np.array(y_batch)
+            if self._transform is not None:
+                # Samples are transformed together once the batch is complete
+                x_layout = self._sample_layout(x_samples[0], None)[0] if x_samples else None
+                y_layout = self._sample_layout(y_samples[0], None)[0] if y_samples else None
+                if not (self._valid_layout(x_data, x_layout) and self._valid_layout(y_data, y_layout)):
+                    err_msg = "Channel shapes don't match the batch in {}".format(
+                        sources.get("filename"))
+                    self._log_error(err_msg)
+                    continue
+                x_samples.append(x_data)
+                y_samples.append(y_data)
+            else:
+                if batch_idx == 0:
+                    x_batch = x_buffers.get(*self._sample_layout(x_data, self.x_dtype))
+                    y_batch = y_buffers.get(*self._sample_layout(y_data, self.y_dtype))
+                # Without a requested dtype, later samples may need a wider one
+                if self.x_dtype is None:
+                    x_batch = self._promoted_batch(x_batch, batch_idx, x_data)
+                if self.y_dtype is None:
+                    y_batch = self._promoted_batch(y_batch, batch_idx, y_data)
+                try:
+                    self._fill_sample(x_batch, batch_idx, x_data)
+                    self._fill_sample(y_batch, batch_idx, y_data)
+                except ValueError:
+                    err_msg = "Channel shapes don't match the batch in {}".format(
+                        sources.get("filename"))
+                    self._log_error(err_msg)
+                    continue
+            sources_batch.append(sources)
+            batch_idx += 1
+            self.stats.incr("samples")
+
+            if batch_idx == batch_size:
+                if self._transform is not None:
+                    with self.stats.timer("transform"):
+                        x_batch, y_batch = self._transform_batch(x_samples, y_samples,
+                            x_buffers, y_buffers, rng)
+                    x_samples, y_samples = [], []
+                self.stats.incr("batches")
+                yield self._make_batch(sources_batch, x_batch, y_batch)
+                n_batches += 1
+                x_batch, y_batch, sources_batch = None, None, []
+                batch_idx = 0
+
+        if batch_idx > 0 and self._transform is not None:
+            with self.stats.timer("transform"):
+                x_batch, y_batch = self._transform_batch(x_samples, y_samples,
+                    x_buffers, y_buffers, rng)
+        if batch_idx > 0:
+            self.stats.incr("batches")
+            yield self._make_batch(sources_batch, x_batch[:batch_idx], y_batch[:batch_idx])
+        elif n_batches == 0:
+            yield self._make_batch(sources_batch, np.array([]), np.array([]))
+
+    def generate_batch(self, batch_size=8, shuffle=True, prefetch=0, workers=None,
+            worker_type="thread", reuse_buffers=0):
+        """Return batch of Dicoms and Contours
+
+        :param batch_size: Length of each batch.  Default to 8
+        :param shuffle: When True, randomly shuffled batch data
+        :param prefetch: Number of batches to build ahead in a background thread.
+            Default to 0 (batches are built on demand)
+        :param workers: Number of workers loading files concurrently when prefetching
+            from a folder.  Default to None (files are loaded by the background thread)
+        :param worker_type: "thread" or "process" pool for the file loading workers
+        :param reuse_buffers: Size of the ring of batch arrays reused across batches.
+            A yielded batch is overwritten `reuse_buffers` batches later, so it must
+            be consumed (or copied) before then.  Default to 0 (new arrays per batch)
+        :return: Numpy Array with shape (batch_size, width, height)
+        """
+        if reuse_buffers and prefetch and reuse_buffers < prefetch + 2:
+            raise ValueError("reuse_buffers must be at least prefetch + 2 when prefetching")
+        if not prefetch:
+            contours_generator = self._contours_generator(shuffle, read_size=batch_size)
+            batches = self._batch_generator(contours_generator, batch_size, reuse_buffers)
+            for batch in batches:
+                yield batch
+            return
+
+        executor = None
+        if workers and self._contour_dicom_folder:
+            if worker_type == "process":
+                from concurrent.futures import ProcessPoolExecutor
+                executor = ProcessPoolExecutor(max_workers=workers)
+            else:
+                executor = ThreadPoolExecutor(max_workers=workers)
+        # Keep enough files in flight to fill the prefetched batches
+        window = max(workers or 1, batch_size * prefetch)
+        contours_generator = self._contours_generator(shuffle, executor, window, batch_size)
+        batches = BackgroundGenerator(
+            self._batch_generator(contours_generator, batch_size, reuse_buffers),
+            max_prefetch=prefetch)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    break
+                self.stats.observe("queue_wait", time.perf_counter() - start)
+                yield batch
+        finally:
+            batches.close()
+            if executor is not None:
+                executor.shutdown(wait=True)
@@ -0,0 +1,118 @@
+import numpy as np
+
+DERIVED_CHANNELS = {}
+
+
+class DerivedChannel(object):
+    """Channel computed from other channels of the same slice.
+
+    func takes the input channels, in the order of inputs, as arrays of shape
+    (..., height, width) and returns an array of the same shape, so it can be
+    applied to one slice or a stack of slices.
+    The version is recorded in the sources of the saved datasets; bump it when
+    func changes so the stored channel is recomputed.
+    """
+
+    def __init__(self, name, inputs, func, version=1):
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.func = func
+        self.version = version
+
+    @property
+    def source(self):
+        """Sources entry of the channel in the saved datasets"""
+        return "derived:v{}".format(self.version)
+
+    def compute(self, datasets):
+        """Return the channel computed from the input channels in datasets"""
+        return self.func(*[datasets[key] for key in self.inputs])
+
+
+def register_channel(name, inputs, func, version=1):
+    """Register a derived channel, usable as any other channel name"""
+    channel = DerivedChannel(name, inputs, func, version)
+    DERIVED_CHANNELS[name] = channel
+    return channel
+
+
+def get_channel(name):
+    """Return the registered derived channel name, None if it isn't one"""
+    return DERIVED_CHANNELS.get(name)
+
+
+def add_derived_channels(names, datasets, sources=None):
+    """Add the derived channels names to datasets, in place, when their inputs are present
+
+    Channels already in datasets are kept unless sources records another version.
+    """
+    for name in names:
+        channel = DERIVED_CHANNELS[name]
+        if name in datasets and (sources is None or sources.get(name, channel.source) == channel.source):
+            continue
+        if all(key in datasets for key in channel.inputs):
+            datasets[name] = channel.compute(datasets)
+            if sources is not None:
+                sources[name] = channel.source
+    return datasets
+
+
+def _shifted(padded, axis, offset, size):
+    """Return the size long window of padded starting at offset along axis"""
+    index = [slice(None)] * padded.ndim
+    index[axis] = slice(offset, offset + size)
+    return padded[tuple(index)]
+
+
+def binary_erosion(masks, size=5):
+    """Erode the last two axes of masks with a size x size square
+
+    Same as scipy.ndimage.grey_erosion(mask, size=(size, size)) on a boolean mask.
+    """
+    radius = size // 2
+    eroded = masks.astype(bool)
+    for axis in (-2, -1):
+        pad_width = [(0, 0)] * eroded.ndim
+        pad_width[axis] = (radius, radius)
+        padded = np.pad(eroded, pad_width, mode="symmetric")
+        axis_size = eroded.shape[axis]
+        eroded = _shifted(padded, axis, 0, axis_size).copy()
+        for offset in range(1, size):
+            eroded &= _shifted(padded, axis, offset, axis_size)
+    return eroded
+
+
+def sobel_magnitude(images):
+    """Return the Sobel gradient magnitude of the last two axes of images (zero padded)
+
+    Same as np.hypot(ndimage.sobel(x, axis=0, mode="constant"),
+    ndimage.sobel(x, axis=1, mode="constant")) for single images.
+    """
+    images = np.asarray(images, dtype=np.float64)
+    pad_width = [(0, 0)] * (images.ndim - 2) + [(1, 1), (1, 1)]
+    padded = np.pad(images, pad_width, mode="constant")
+    height, width = images.shape[-2:]
+
+    def window(row, col):
+        return padded[..., row:row + height, col:col + width]
+
+    # Smooth across one axis with [1, 2, 1] then differentiate along the other with [-1, 0, 1]
+    rows = window(0, 0) + 2 * window(0, 1) + window(0, 2)
+    rows_after = window(2, 0) + 2 * window(2, 1) + window(2, 2)
+    cols = window(0, 0) + 2 * window(1, 0) + window(2, 0)
+    cols_after = window(0, 2) + 2 * window(1, 2) + window(2, 2)
+    return np.hypot(rows_after - rows, cols_after - cols)
+
+
+def _masked_dicom(dicom, o_contours):
+    return np.where(o_contours, dicom, 0)
+
+
+def _contour_outline(o_contours):
+    o_contours = o_contours.astype(bool)
+    return o_contours & ~binary_erosion(o_contours)
+
+
+register_channel("masked-dicom", ("dicom", "o-contours"), _masked_dicom)
+register_channel("o-contours-outline", ("o-contours",), _contour_outline)
+register_channel("dicom-sobel", ("dicom",), sobel_magnitude)
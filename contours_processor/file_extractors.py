@@ -3,16 +3,61 @@ import os.path
 import numpy as np
 from glob import glob
 import logging
+from io import BytesIO
+from functools import partial
 
-import dicom
-from dicom.errors import InvalidDicomError
-
-from PIL import Image, ImageDraw
-
+# dicom, PIL and the asyncio API are imported on first use so that importing the
+# package stays cheap for processes that only read preprocessed datasets
 from . import logger
-from .utils import dump_dataset
+from .utils import dump_dataset, parse_contour_coords, _padded_shard
+from .stores import PackedDatasetWriter, NpyDatasetWriter
+from .manifest import DatasetManifest
+from .index import ContourFileIndex
+from .stats import NullStats, _call_collecting_stats
+from .features import get_channel, add_derived_channels
+from .pipeline import Pipeline
 from .exceptions import InvalidDatasetError
 
+# Extractor of a worker process, sent once by the pool initializer, and the event
+# set by the first worker failing so the others stop
+_worker_extractor = None
+_worker_stop = None
+
+
+def _init_worker(extractor, stop_event=None):
+    global _worker_extractor, _worker_stop
+    _worker_extractor = extractor
+    _worker_stop = stop_event
+
+
+def _call_collecting_counters(func, *args):
+    """Run method func of an extractor in a worker process
+
+    :return: (result, stats snapshot, DICOM cache (hits, disk_hits, misses) counted by the call)
+    """
+    cache = func.__self__.dicom_cache
+    before = cache.counters() if cache is not None else None
+    result, snapshot = _call_collecting_stats(func, *args)
+    cache_counts = None
+    if cache is not None:
+        cache_counts = tuple(after - count for after, count in zip(cache.counters(), before))
+    return result, snapshot, cache_counts
+
+
+def _call_worker(method, *args):
+    """Run method of the worker process extractor, see _call_collecting_counters
+
+    Once a worker has failed, return (None, None, None) without running method.
+    """
+    if _worker_stop is not None and _worker_stop.is_set():
+        return None, None, None
+    try:
+        return _call_collecting_counters(getattr(_worker_extractor, method), *args)
+    except Exception:
+        if _worker_stop is not None:
+            _worker_stop.set()
+        raise
+
 
 class ContourFileExtractor(object):
     """Parse Contour and Dicoms Files for use with ContourDataset.
@@ -22,6 +67,8 @@ class ContourFileExtractor(object):
 
     def _contour_secondary_filepath_extractor(self, secondary_type, contour_filepath):
         """Return the filepath for the secondary contour file"""
+        if self.file_index is not None:
+            return self.file_index.lookup(contour_filepath, secondary_type)
         contour_type_mapper = {
             "i-contours": "icontour",
             "o-contours": "ocontour"
@@ -54,9 +101,7 @@ class ContourFileExtractor(object):
 
         # Verify that i-contours is a subset of o-contors
         if "i-contours" in datasets and "o-contours" in datasets:
-            invalid_pixels = np.where((datasets["o-contours"] == 0) &
-                (datasets["i-contours"] > 0))[0]
-            if len(invalid_pixels) > 0:
+            if np.any((datasets["o-contours"] == 0) & (datasets["i-contours"] > 0)):
                 return False  # i-contours should be fully contained in o-contours
         return True
 
@@ -65,6 +110,8 @@ class ContourFileExtractor(object):
             contour_filepath,
             contour_dicom_folder_map=None):
         """Return the dicom filepath for the given contour filename"""
+        if self.file_index is not None:
+            return self.file_index.lookup(contour_filepath, "dicom")
         contour_file_tree = contour_filepath.split("/")
         contour_folder, contour_type, contour_filename = contour_file_tree[-3:]
         dicom_folder = contour_dicom_folder_map.get(contour_folder)
@@ -102,8 +149,34 @@ class ContourFileExtractor(object):
             dicom_filepath_extractor=None,
             contour_secondary_filepath_extractor=None,
             dataset_validator=None,
-            save_filepath_extractor=None):
-        """Create a Dataset with given parameters"""
+            save_filepath_extractor=None,
+            dicom_cache=None,
+            file_index=None,
+            stats=None,
+            storage_options=None,
+            derived_channels=None):
+        """Create a Dataset with given parameters
+
+        dicom_cache is an optional DicomCache reused across contour types and runs
+        so each DICOM file is only decoded once.
+
+        file_index is an optional ContourFileIndex (see build_file_index).  When set,
+        the contour files and their dicom / secondary contour files are looked up
+        in the index instead of the file system.
+
+        stats is an optional PipelineStats collecting per-stage timings (resolve_paths,
+        dicom_decode, contour_parse, validate, write) and counters (files_processed,
+        validation_failures, dicom_errors, bytes_written...).  Default to NullStats.
+
+        storage_options are passed to dump_dataset when saving HDF5 files, ex:
+        {"compression": "gzip", "mask_encoding": "packbits", "rescale_dtype": "int16"}.
+        With rescale_dtype, the DICOM is stored as rescale_dtype pixels with its
+        slope and intercept (when lossless) and rescaled by load_dataset.
+
+        derived_channels lists registered derived channels (see features, ex:
+        "masked-dicom", "o-contours-outline", "dicom-sobel") computed once per slice
+        and saved with the other channels.
+        """
         self._contour_root = contour_top_folder
         self._dicom_root = dicom_top_folder
         self.primary_contour = primary_contour
@@ -113,6 +186,14 @@ class ContourFileExtractor(object):
         self._target_size = target_size
         self._padding = padding
         self._on_error_action = on_error_action
+        self.dicom_cache = dicom_cache
+        self.file_index = file_index
+        self.stats = stats if stats is not None else NullStats()
+        self.storage_options = dict(storage_options or {})
+        self.derived_channels = list(derived_channels or [])
+        for name in self.derived_channels:
+            if get_channel(name) is None:
+                raise ValueError("Unknown derived channel: {}".format(name))
         self._contour_dicom_folder_map = contour_dicom_folder_map
         if dicom_filepath_extractor is None:
             self.dicom_filepath_extractor = self._dicom_filepath_extractor
@@ -138,50 +219,166 @@ class ContourFileExtractor(object):
         :param filename: filepath to the DICOM file to parse
         :return: dictionary with DICOM image data
         """
+        return self._decode_dicom_file(filename)[0]
+
+    def _decode_dicom_file(self, filename):
+        """Parse the given DICOM filename (or file object), reading it once
+
+        :return: (DICOM image data, (slope, intercept) applied to its pixels),
+            (None, None) when it isn't a DICOM file
+        """
+        import dicom
+        from dicom.errors import InvalidDicomError
         try:
             dcm = dicom.read_file(filename)
             dcm_image = dcm.pixel_array
-            # TODO: Crop and Pad DCM image to target size
-            try:
-                intercept = dcm.RescaleIntercept
-            except AttributeError:
-                intercept = 0.0
-            try:
-                slope = dcm.RescaleSlope
-            except AttributeError:
-                slope = 0.0
-
-            if intercept != 0.0 and slope != 0.0:
+            slope, intercept = self._dicom_rescale(dcm)
+            if (slope, intercept) != (1.0, 0.0):
                 dcm_image = dcm_image * slope + intercept
-            return dcm_image
+            return dcm_image, (slope, intercept)
         except InvalidDicomError:
-            return None
+            return None, None
+
+    def _dicom_rescale(self, dcm):
+        """Return the (slope, intercept) applied to the DICOM pixels, (1.0, 0.0) when not rescaled"""
+        try:
+            intercept = dcm.RescaleIntercept
+        except AttributeError:
+            intercept = 0.0
+        try:
+            slope = dcm.RescaleSlope
+        except AttributeError:
+            slope = 0.0
+
+        if intercept != 0.0 and slope != 0.0:
+            return float(slope), float(intercept)
+        return 1.0, 0.0
+
+    def _read_dicom_rescale(self, filename):
+        """Return the (slope, intercept) of a DICOM file (or file object), reading only its header"""
+        import dicom
+        from dicom.errors import InvalidDicomError
+        try:
+            return self._dicom_rescale(dicom.read_file(filename, stop_before_pixels=True))
+        except InvalidDicomError:
+            return 1.0, 0.0
+
+    def build_file_index(self, index_filepath=None):
+        """Scan the contour and dicom folders once and use the index for all lookups
+
+        :param index_filepath: When given, load the index from this file if it exists,
+            otherwise save the new index to it
+        :return: the ContourFileIndex, which can be filtered or split and set back
+            on file_index before extraction
+        """
+        if index_filepath and os.path.isfile(index_filepath):
+            self.file_index = ContourFileIndex.load(index_filepath)
+        else:
+            self.file_index = ContourFileIndex.build(self._contour_root, self._dicom_root,
+                self._contour_dicom_folder_map)
+            if index_filepath:
+                self.file_index.save(index_filepath)
+        return self.file_index
+
+    def _load_dicom_file(self, filename, data=None):
+        """Return the DICOM image data and its (slope, intercept), through the DICOM cache
+
+        The DICOM cache keeps the rescale of the pixels next to them.
+
+        :param data: Content of the file when it was already read.  Default to None
+        :return: (image data, (slope, intercept)), (None, None) when it can't be parsed
+        """
+        if filename is None:
+            return None, None
+        decoded = []
+
+        def decode_dicom_file(filename):
+            decoded[:] = self._decode_dicom_file(filename if data is None else BytesIO(data))
+            return decoded[0]
+
+        def load_rescale(filename):
+            # The rescale of pixels cached by an earlier run is read from the header
+            rescale = decoded[1] if decoded else self._read_dicom_rescale(
+                filename if data is None else BytesIO(data))
+            return np.array(rescale, dtype=np.float64)
+
+        with self.stats.timer("dicom_decode"):
+            if self.dicom_cache is None:
+                dicom_data = decode_dicom_file(filename)
+                rescale = decoded[1]
+            else:
+                dicom_data = self.dicom_cache.get(filename, decode_dicom_file)
+                rescale = None
+                if dicom_data is not None:
+                    slope, intercept = self.dicom_cache.get(filename, load_rescale, kind="rescale")
+                    rescale = (float(slope), float(intercept))
+        if dicom_data is None:
+            return None, None
+        return self._fit_dicom_image(dicom_data), rescale
+
+    def _fit_dicom_image(self, dicom_data):
+        """Crop and zero pad the DICOM image at the bottom / right to the target size
+
+        The contour coordinates are DICOM pixel coordinates, so keeping the top left
+        origin lines the image up with the masks rasterised at the target size.
+        """
+        width, height = self._target_size
+        dicom_data = dicom_data[:height, :width]
+        if dicom_data.shape != (height, width):
+            dicom_data = np.pad(dicom_data, ((0, height - dicom_data.shape[0]),
+                (0, width - dicom_data.shape[1])), mode="constant")
+        return dicom_data
 
     def _parse_contour_file(self, filename):
         """Parse the given contour filename
 
         :param filename: filepath to the contourfile to parse
-        :return: list of tuples holding x, y coordinates of the contour
+        :return: boolean mask of the filled contour
         """
+        masks, is_valid = self._parse_contour_files([filename])
+        if is_valid[0]:
+            return masks[0]
+
+    def _read_contour_coords(self, filename, data=None):
+        """Return (n, 2) array of the x, y coordinates in the contour file (or its data bytes)"""
+        if data is not None:
+            return parse_contour_coords(data.decode("utf-8"))
         if filename is None:
             return None
-
-        coords_lst = []
         with open(filename, 'r') as infile:
-            for line in infile:
-                coords = line.strip().split()
+            return parse_contour_coords(infile.read())
 
-                x_coord = float(coords[0])
-                y_coord = float(coords[1])
-                coords_lst.append((x_coord, y_coord))
+    def _parse_contour_files(self, filenames, file_bytes=None):
+        """Parse and rasterise all the given contour files in a single call
 
-        if self._is_valid_contours(coords_lst):
+        :param filenames: list of filepaths to the contourfiles.  None entries are skipped
+        :param file_bytes: Dictionary of filepath -> content of the files already read
+        :return: boolean masks of shape (len(filenames), height, width) and list of
+            flags telling which masks hold a valid contour
+        """
+        if file_bytes is None:
+            file_bytes = {}
+        width, height = self._target_size
+        masks = np.zeros((len(filenames), height, width), dtype=bool)
+        coords_lst = [self._read_contour_coords(filename, file_bytes.get(filename))
+            for filename in filenames]
+        is_valid = [self._is_valid_contours(coords) for coords in coords_lst]
+        from PIL import Image, ImageDraw
+        for idx, coords in enumerate(coords_lst):
+            if not is_valid[idx]:
+                continue
             img = Image.new(mode='L', size=self._target_size, color=0)
-            ImageDraw.Draw(img).polygon(xy=coords_lst, outline=0, fill=1)
-            mask = np.array(img).astype(bool)
-            return mask
+            ImageDraw.Draw(img).polygon(xy=coords.ravel().tolist(), outline=0, fill=1)
+            masks[idx] = np.asarray(img).view(bool)
+        return masks, is_valid
 
     def _get_contour_files(self, shuffle):
+        if self.file_index is not None:
+            contour_files = self.file_index.contour_files(self.primary_contour)
+            if shuffle:
+                contour_files = np.random.permutation(contour_files)
+            return contour_files
+
         contour_files = []
         for contour_folder in self._contour_dicom_folder_map.keys():
             contour_folder_files = glob(os.path.join(
@@ -192,44 +389,82 @@ class ContourFileExtractor(object):
             contour_files = np.random.permutation(contour_files)
         return contour_files
 
-    def _extract_dicom_contour_file(self, contour_path):
-        """Return Prased Datasets and Sources.
+    def _get_shard_contour_files(self, shuffle, num_shards=1, shard_index=0):
+        """Return the contour files of shard shard_index out of num_shards
+
+        The sorted contour files are split as the samples of a sharded ContourDataset,
+        so every shard has the same number of files.  Each shard shuffles its own files.
+        """
+        if num_shards == 1:
+            return self._get_contour_files(shuffle)
+        if not 0 <= shard_index < num_shards:
+            raise InvalidDatasetError("shard_index must be between 0 and num_shards - 1")
+        contour_files = _padded_shard(sorted(self._get_contour_files(False)), num_shards,
+            shard_index)
+        if shuffle:
+            contour_files = np.random.permutation(contour_files)
+        return contour_files
+
+    def _extract_dicom_contour_file(self, contour_path, file_bytes=None, inputs=None):
+        """Return Prased Datasets and Sources, see _extract_rescaled"""
+        return self._extract_rescaled(contour_path, file_bytes, inputs)[:2]
+
+    def _extract_rescaled(self, contour_path, file_bytes=None, inputs=None):
+        """Return Prased Datasets, Sources and the (slope, intercept) of the Dicom.
 
         Navigate the Contour Path to get Dicom and Contour Files.
         Extract them as numpy arrays in Datasets.
+
+        :param file_bytes: Dictionary of filepath -> content of the Dicom and Contour
+            Files already read (see aio).  Default to None (read the files)
+        :param inputs: Input files of contour_path already resolved with
+            _contour_file_inputs.  Default to None (resolve them)
+        :return: (datasets, sources, rescale), rescale is None without a Dicom
         """
+        if file_bytes is None:
+            file_bytes = {}
         datasets = {}
         sources = {}
+        self.stats.incr("files_processed")
+        with self.stats.timer("resolve_paths"):
+            if inputs is None:
+                inputs = self._contour_file_inputs(contour_path)
+            dicom_path = inputs["dicom"]
+            contour_types = [self.primary_contour] + list(self.secondary_contours)
+            contour_paths = [contour_path] + [inputs[secondary_contour]
+                for secondary_contour in self.secondary_contours]
+
         # Parse Dicoms
-        dicom_path = self.dicom_filepath_extractor(self._dicom_root, contour_path,
-            self._contour_dicom_folder_map)
-        dicom_data = self._parse_dicom_file(dicom_path)
+        dicom_data, rescale = self._load_dicom_file(dicom_path, file_bytes.get(dicom_path))
         if dicom_path and dicom_data is not None:
             datasets["dicom"] = dicom_data
             sources["dicom"] = dicom_path
         else:
+            self.stats.incr("dicom_errors")
             err_msg = "Dicom File Parse Error: {}".format(dicom_path)
             self._log_error(err_msg)
 
-        # Parse Primary Contour
-        contour_data = self._parse_contour_file(contour_path)
-        if contour_data is not None:
-            datasets[self.primary_contour] = contour_data
+        # Parse Primary and Secondary Contours in a single call
+        with self.stats.timer("contour_parse"):
+            contour_masks, is_valid = self._parse_contour_files(contour_paths, file_bytes)
+
+        if is_valid[0]:
+            datasets[self.primary_contour] = contour_masks[0]
             sources[self.primary_contour] = contour_path
         else:
+            self.stats.incr("contour_errors")
             err_msg = "Dicom File Parse Error: {}".format(dicom_path)
             self._log_error(err_msg)
 
-        # Parse Secondary Contours
-        for secondary_contour in self.secondary_contours:
-            contour_seconday_filepath = self.contour_secondary_filepath_extractor(
-                secondary_contour, contour_path)
-            contour_data = self._parse_contour_file(contour_seconday_filepath)
-            if contour_data is not None:
-                datasets[secondary_contour] = contour_data
-                sources[secondary_contour] = contour_seconday_filepath
+        for idx in range(1, len(contour_types)):
+            if is_valid[idx]:
+                datasets[contour_types[idx]] = contour_masks[idx]
+                sources[contour_types[idx]] = contour_paths[idx]
 
-        return datasets, sources
+        if self.derived_channels:
+            with self.stats.timer("derived_channels"):
+                add_derived_channels(self.derived_channels, datasets, sources)
+        return datasets, sources, rescale
 
     def _split_contour_path(self, contour_path):
         # example: SC-HF-I-1/i-contours/IM-0001-0048-icontour-manual.txt
@@ -245,26 +480,316 @@ class ContourFileExtractor(object):
             output_filename = "{}-{}-dicom-contours.h5".format(contour_folder, file_prefix)
             return os.path.join(output_dir, output_filename)
 
-    def datasets_generator(self, shuffle=False):
-        """Return batch of Datasets and Sources from Dicom / Contours file"""
-        contour_files = self._get_contour_files(shuffle)
+    def datasets_generator(self, shuffle=False, num_shards=1, shard_index=0):
+        """Return batch of Datasets and Sources from Dicom / Contours file
+
+        :param num_shards: Split the contour files between data parallel workers, each
+            worker only extracting the files of its shard_index (see ContourDataset)
+        """
+        contour_files = self._get_shard_contour_files(shuffle, num_shards, shard_index)
         for contour_path in contour_files:
             datasets, sources = self._extract_dicom_contour_file(contour_path)
-            if datasets and self.dataset_validator(datasets):
+            if self._validate(datasets):
                 yield datasets, sources
             else:
                 self._log_error("Dataset failed validation {}".format(contour_path))
 
-    def save_datasets(self, output_dir, n_samples=None, shuffle=False):
-        """Save Datasets and Sources metadata in output directory"""
-        contour_files = self._get_contour_files(shuffle)
+    def pipeline_generator(self, shuffle=False, extract_workers=4, validate_workers=1,
+            queue_size=16, ordered=True, extract_processes=None, num_shards=1, shard_index=0):
+        """Return generator of Datasets and Sources extracted by a pipeline of worker threads
 
-        for idx, contour_path in enumerate(contour_files):
-            if n_samples and idx > n_samples:
-                break
-            datasets, sources = self._extract_dicom_contour_file(contour_path)
-            output_filepath = self.save_filepath_extractor(output_dir, contour_path, sources)
-            if output_filepath and self.dataset_validator(datasets):
-                dump_dataset(output_filepath, datasets, sources)
+        Extraction (DICOM decode and contour rasterisation) and validation run as
+        stages with their own worker counts, linked by queues of queue_size samples.
+        With on_error_action other than "raise", invalid samples are logged and
+        dropped without stalling the pipeline.
+
+        The stage workers are threads.  DICOM decoding and contour drawing mostly
+        hold the GIL, so more extract threads only overlap the file reads.  Set
+        extract_processes to extract in a pool of processes, which receive the
+        extractor once when they start: each extract worker thread then keeps one
+        contour file in flight in the pool, so use at least as many extract_workers
+        as extract_processes.
+
+        Batching and transforms aren't stages of this pipeline.  Use the generator as
+        the contour_dicom_generator of ContourDataset with generate_batch(prefetch=...)
+        to build the batches in a background thread.
+
+        num_shards / shard_index extract only a shard of the files, as datasets_generator.
+        """
+        contour_files = self._get_shard_contour_files(shuffle, num_shards, shard_index)
+        pool = None
+        extract = self._extract_sample
+        if extract_processes:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(max_workers=extract_processes, initializer=_init_worker,
+                initargs=(self,))
+            extract = partial(self._submit_extract, pool)
+        pipeline = Pipeline(contour_files, queue_size=queue_size, ordered=ordered)
+        pipeline.add_stage(extract, extract_workers, "extract")
+        pipeline.add_stage(self._validate_sample, validate_workers, "validate")
+        try:
+            for sample in pipeline:
+                yield sample
+        finally:
+            pipeline.close()
+            if pool is not None:
+                pool.shutdown(wait=True)
+
+    def _extract_sample(self, contour_path):
+        datasets, sources = self._extract_dicom_contour_file(contour_path)
+        return contour_path, datasets, sources
+
+    def _submit_extract(self, pool, contour_path):
+        """Extract contour_path in the worker processes, merging the counters they recorded"""
+        result, snapshot, cache_counts = pool.submit(_call_worker, "_extract_sample",
+            contour_path).result()
+        self._merge_worker_counters(snapshot, cache_counts)
+        return result
+
+    def _merge_worker_counters(self, snapshot, cache_counts):
+        """Merge the stats snapshot and DICOM cache counts sent back by a worker process"""
+        self.stats.merge(snapshot)
+        if cache_counts is not None and self.dicom_cache is not None:
+            self.dicom_cache.merge_counters(cache_counts)
+
+    def _validate_sample(self, sample):
+        """Return (datasets, sources) of a valid sample, None (dropped) otherwise"""
+        contour_path, datasets, sources = sample
+        if self._validate(datasets):
+            return datasets, sources
+        self._log_error("Dataset failed validation {}".format(contour_path))
+
+    def _validate(self, datasets):
+        """Return True if the datasets are not empty and pass the dataset validator"""
+        with self.stats.timer("validate"):
+            is_valid = bool(datasets) and self.dataset_validator(datasets)
+        if not is_valid:
+            self.stats.incr("validation_failures")
+        return is_valid
+
+    def datasets_generator_async(self, shuffle=False, concurrency=16, executor=None, ordered=True):
+        """Return async iterator of Datasets and Sources, reading the files concurrently
+
+        :param concurrency: Maximum number of contour files whose files are read at once
+        :param executor: concurrent.futures Executor decoding the files.  Default to
+            None (the event loop default executor)
+        :param ordered: When False, yield the datasets as soon as they are decoded
+        """
+        from . import aio
+        return aio.datasets_generator(self, shuffle, concurrency, executor, ordered)
+
+    def save_datasets_async(self, output_dir, n_samples=None, shuffle=False, concurrency=16,
+            executor=None):
+        """Coroutine saving the HDF5 files like save_datasets, reading the files concurrently
+
+        :return: Dictionary with the count of "saved", "skipped" and "failed" files
+        """
+        from . import aio
+        return aio.save_datasets(self, output_dir, n_samples, shuffle, concurrency, executor)
+
+    def _save_contour_file(self, output_dir, contour_path, file_bytes=None, inputs=None):
+        """Extract, validate and save the datasets for a single contour file.
+
+        :return: "saved", "skipped" when no output filepath could be derived
+            or "failed" when the datasets didn't pass validation
+        """
+        datasets, sources, rescale = self._extract_rescaled(contour_path, file_bytes, inputs)
+        output_filepath = self.save_filepath_extractor(output_dir, contour_path, sources)
+        if output_filepath is None:
+            self._log_error("No output filepath for {}".format(contour_path))
+            return "skipped"
+        if self._validate(datasets):
+            with self.stats.timer("write"):
+                dump_dataset(output_filepath, datasets, sources,
+                    **self._dump_options(sources, rescale))
+            if self.stats.enabled:
+                self.stats.incr("bytes_written", os.path.getsize(output_filepath))
+            return "saved"
+        self._log_error("Dataset failed validation {}".format(output_filepath))
+        return "failed"
+
+    def _dump_options(self, sources, rescale=None):
+        """Return the dump_dataset keyword arguments for the storage options
+
+        :param rescale: (slope, intercept) of the Dicom from its decode
+        """
+        options = dict(self.storage_options)
+        if options.get("rescale_dtype") and "dicom" in sources and rescale is not None:
+            # DICOMs without a rescale already have integer pixels, keep them as is
+            if rescale != (1.0, 0.0):
+                options["rescale"] = {"dicom": rescale}
+        return options
+
+    def _extract_valid_contour_file(self, contour_path, file_bytes=None, inputs=None):
+        """Return ("saved", datasets, sources) or ("failed", None, None) on validation failure"""
+        datasets, sources = self._extract_dicom_contour_file(contour_path, file_bytes, inputs)
+        if self._validate(datasets):
+            return "saved", datasets, sources
+        self._log_error("Dataset failed validation {}".format(contour_path))
+        return "failed", None, None
+
+    def _map_contour_files(self, func, contour_files, workers=None, executor=None, args=()):
+        """Yield func(*args, contour_path) for each contour file, in order
+
+        func is a method of the extractor.  The stats and DICOM cache counters of worker
+        processes are sent back and merged in self.stats and self.dicom_cache.  When func
+        raises (on_error_action="raise"), the files not started yet are cancelled and the
+        error is raised.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        args = tuple(args)
+        arg_lists = [[arg] * len(contour_files) for arg in args]
+        if executor is not None:
+            # executor.map pickles func, and so the extractor, with every chunk of files
+            chunksize = max(1, len(contour_files) // 64)
+            if isinstance(executor, ProcessPoolExecutor):
+                results = executor.map(_call_collecting_counters, [func] * len(contour_files),
+                    *arg_lists + [contour_files], chunksize=chunksize)
+                for result, snapshot, cache_counts in results:
+                    self._merge_worker_counters(snapshot, cache_counts)
+                    yield result
+            else:
+                for result in executor.map(func, *arg_lists + [contour_files], chunksize=chunksize):
+                    yield result
+        elif workers and workers > 1:
+            # The workers receive the extractor once and stop after the first failure
+            stop_event = multiprocessing.Event()
+            chunksize = max(1, len(contour_files) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                    initargs=(self, stop_event)) as pool:
+                results = pool.map(partial(_call_worker, func.__name__),
+                    *arg_lists + [contour_files], chunksize=chunksize)
+                try:
+                    for result, snapshot, cache_counts in results:
+                        if snapshot is None:
+                            continue  # Not run after another file failed, its error follows
+                        self._merge_worker_counters(snapshot, cache_counts)
+                        yield result
+                finally:
+                    # Stop the queued files too when the caller stops early
+                    stop_event.set()
+        else:
+            for contour_path in contour_files:
+                yield func(*args + (contour_path,))
+
+    def _contour_file_inputs(self, contour_path):
+        """Return dictionary of the input files the datasets of contour_path are built from"""
+        inputs = {
+            "dicom": self.dicom_filepath_extractor(self._dicom_root, contour_path,
+                self._contour_dicom_folder_map),
+            self.primary_contour: contour_path,
+        }
+        for secondary_contour in self.secondary_contours:
+            inputs[secondary_contour] = self.contour_secondary_filepath_extractor(
+                secondary_contour, contour_path)
+        return inputs
+
+    def _manifest_settings(self):
+        """Return the extractor settings that affect the saved datasets"""
+        return {
+            "target_size": list(self._target_size),
+            "padding": self._padding,
+            "primary_contour": self.primary_contour,
+            "secondary_contours": list(self.secondary_contours),
+            "storage_options": self.storage_options,
+            "derived_channels": {name: get_channel(name).version for name in self.derived_channels},
+        }
+
+    def _save_incremental(self, output_dir, contour_files, workers, executor, manifest_check):
+        """Save the datasets whose inputs changed since they were recorded in the manifest"""
+        manifest = DatasetManifest(output_dir, self._manifest_settings(), check=manifest_check)
+        summary = {"saved": 0, "skipped": 0, "failed": 0, "unchanged": 0}
+        pending = []
+        for contour_path in contour_files:
+            inputs = self._contour_file_inputs(contour_path)
+            output_filepath = self.save_filepath_extractor(output_dir, contour_path, inputs)
+            signatures = manifest.signatures(inputs)
+            if output_filepath and manifest.is_current(output_filepath, signatures):
+                summary["unchanged"] += 1
+                self.stats.incr("files_unchanged")
             else:
-                self._log_error("Dataset failed validation {}".format(output_filepath))
+                pending.append((contour_path, output_filepath, signatures))
+
+        pending_files = [contour_path for contour_path, _, _ in pending]
+        statuses = self._map_contour_files(self._save_contour_file, pending_files,
+            workers, executor, args=(output_dir,))
+        try:
+            for (contour_path, output_filepath, signatures), status in zip(pending, statuses):
+                summary[status] += 1
+                self.stats.incr("files_{}".format(status))
+                if status == "saved":
+                    manifest.record(output_filepath, signatures)
+        finally:
+            # Keep what was saved so far when the run is interrupted
+            manifest.flush()
+        return summary
+
+    def save_datasets(self, output_dir, n_samples=None, shuffle=False, workers=None, executor=None,
+            output_format="hdf5", shard_size=None, packed_name="contours-dataset",
+            incremental=False, manifest_check="mtime"):
+        """Save Datasets and Sources metadata in output directory
+
+        :param output_dir: Folder to save the processed HDF5 files
+        :param n_samples: Maximum number of contour files to process
+        :param shuffle: When True, process the contour files in random order
+        :param workers: Number of processes to spread the extraction across.
+            Default to None (process the files serially)
+        :param executor: concurrent.futures Executor to use instead of creating
+            a process pool.  Takes precedence over workers
+        :param output_format: "hdf5" to write one HDF5 file per contour file,
+            "packed" to append all samples into packed_name.h5 (see PackedDatasetWriter)
+            or "npy" to write memory mappable .npy blocks (see NpyDatasetWriter)
+        :param shard_size: Maximum number of samples per packed file.  Default to None
+        :param packed_name: Filename prefix of the packed files
+        :param incremental: When True, skip the outputs whose input files and extractor
+            settings are unchanged since the last run, as recorded in output_dir/manifest.json.
+            Only supported with output_format="hdf5"
+        :param manifest_check: Compare the input files by "mtime" (size and mtime) or "hash"
+        :return: Dictionary with the count of "saved", "skipped" and "failed" files
+            (and "unchanged" ones when incremental)
+        """
+        if output_format not in ("hdf5", "packed", "npy"):
+            raise ValueError("Unknown output_format: {}".format(output_format))
+        if incremental and output_format != "hdf5":
+            raise ValueError("Incremental saving is only supported with output_format='hdf5'")
+        contour_files = self._get_contour_files(shuffle)
+        if n_samples:
+            contour_files = contour_files[:n_samples]
+        if incremental:
+            return self._save_incremental(output_dir, contour_files, workers, executor,
+                manifest_check)
+
+        summary = {"saved": 0, "skipped": 0, "failed": 0}
+        if output_format == "hdf5":
+            statuses = self._map_contour_files(self._save_contour_file, contour_files,
+                workers, executor, args=(output_dir,))
+            for status in statuses:
+                summary[status] += 1
+                self.stats.incr("files_{}".format(status))
+            return summary
+
+        # Packed datasets are extracted in the workers and appended in order here
+        if output_format == "npy":
+            writer = NpyDatasetWriter(output_dir)
+        else:
+            writer = PackedDatasetWriter(output_dir, packed_name, shard_size)
+        with writer:
+            results = self._map_contour_files(self._extract_valid_contour_file, contour_files,
+                workers, executor)
+            for status, datasets, sources in results:
+                if status == "saved":
+                    try:
+                        with self.stats.timer("write"):
+                            writer.append(datasets, sources)
+                    except InvalidDatasetError as e:
+                        # Samples that don't fit the layout of the store aren't written
+                        self._log_error(str(e))
+                        status = "failed"
+                    else:
+                        if self.stats.enabled:
+                            self.stats.incr("bytes_written",
+                                sum(data.nbytes for data in datasets.values()))
+                summary[status] += 1
+                self.stats.incr("files_{}".format(status))
+        return summary
@@ -0,0 +1,119 @@
+import os
+import re
+import json
+import numpy as np
+
+CONTOUR_FILENAME_RE = re.compile(r"IM-0001-(\d{4})-[io]contour.*?\.txt$")
+DICOM_FILENAME_RE = re.compile(r"(\d+)\.dcm$")
+
+
+def _scan_files(folder):
+    """Return list of (filename, filepath) in folder, empty if the folder doesn't exist"""
+    try:
+        return [(entry.name, os.path.join(folder, entry.name))
+                for entry in os.scandir(folder) if entry.is_file()]
+    except OSError:
+        return []
+
+
+class ContourFileIndex(object):
+    """Index of (contour folder, slice number) -> dicom and contour file paths.
+
+    Built with one directory scan per folder, so the extractor can resolve the
+    dicom and secondary contour files of a contour without globbing, regex
+    matching or stat calls.  Entries map "dicom" and each contour type
+    (ex: "o-contours") to their file path.
+    """
+
+    def __init__(self, entries=None):
+        self.entries = entries if entries is not None else {}
+        self._path_keys = None
+
+    @classmethod
+    def build(cls, contour_top_folder, dicom_top_folder, contour_dicom_folder_map):
+        """Scan the contour and dicom folders of contour_dicom_folder_map"""
+        entries = {}
+        for contour_folder, dicom_folder in contour_dicom_folder_map.items():
+            contour_folder_path = os.path.join(contour_top_folder, contour_folder)
+            try:
+                contour_types = [entry.name for entry in os.scandir(contour_folder_path)
+                    if entry.is_dir()]
+            except OSError:
+                contour_types = []
+            for contour_type in contour_types:
+                type_folder = os.path.join(contour_folder_path, contour_type)
+                for filename, filepath in _scan_files(type_folder):
+                    match = CONTOUR_FILENAME_RE.search(filename)
+                    if match:
+                        key = (contour_folder, int(match.group(1)))
+                        entries.setdefault(key, {})[contour_type] = filepath
+
+            for filename, filepath in _scan_files(os.path.join(dicom_top_folder, dicom_folder)):
+                match = DICOM_FILENAME_RE.match(filename)
+                if match:
+                    key = (contour_folder, int(match.group(1)))
+                    if key in entries:
+                        entries[key]["dicom"] = filepath
+        return cls(entries)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an index saved with save()"""
+        with open(filename, "r") as f:
+            rows = json.load(f)
+        return cls({(contour_folder, slice_idx): paths for contour_folder, slice_idx, paths in rows})
+
+    def save(self, filename):
+        """Save the index as JSON"""
+        rows = [[contour_folder, slice_idx, paths]
+                for (contour_folder, slice_idx), paths in sorted(self.entries.items())]
+        with open(filename, "w") as f:
+            json.dump(rows, f)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(sorted(self.entries.items()))
+
+    def _contour_path_keys(self):
+        if self._path_keys is None:
+            self._path_keys = {}
+            for key, paths in self.entries.items():
+                for file_type, path in paths.items():
+                    if file_type != "dicom":
+                        self._path_keys[path] = key
+        return self._path_keys
+
+    def lookup(self, contour_path, file_type):
+        """Return the file_type ("dicom" or a contour type) path of the slice of contour_path"""
+        key = self._contour_path_keys().get(contour_path)
+        if key is not None:
+            return self.entries[key].get(file_type)
+
+    def contour_files(self, contour_type):
+        """Return the sorted list of contour_type files"""
+        return [paths[contour_type] for _, paths in self if contour_type in paths]
+
+    def filter(self, func):
+        """Return a new index with the entries for which func(key, paths) is True"""
+        return ContourFileIndex({key: paths for key, paths in self.entries.items() if func(key, paths)})
+
+    def split(self, fraction, seed=None, by_folder=True):
+        """Return two indexes with fraction and 1 - fraction of the entries.
+
+        :param by_folder: When True, all slices of a contour folder (patient) end up
+            in the same index so that there's no leakage between the splits
+        """
+        rng = np.random.RandomState(seed)
+        if by_folder:
+            groups = sorted(set(contour_folder for contour_folder, _ in self.entries))
+        else:
+            groups = sorted(self.entries)
+        groups = [groups[idx] for idx in rng.permutation(len(groups))]
+        first = set(groups[:int(round(fraction * len(groups)))])
+        if by_folder:
+            return (self.filter(lambda key, paths: key[0] in first),
+                    self.filter(lambda key, paths: key[0] not in first))
+        return (self.filter(lambda key, paths: key in first),
+                self.filter(lambda key, paths: key not in first))
@@ -0,0 +1,83 @@
+import os
+import json
+import hashlib
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+def file_signature(filename, check="mtime"):
+    """Return [size, mtime] (or [size, sha1] when check is "hash") of a file, None if missing"""
+    if filename is None:
+        return None
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if check == "hash":
+        sha1 = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        return [stat.st_size, sha1.hexdigest()]
+    return [stat.st_size, stat.st_mtime]
+
+
+class DatasetManifest(object):
+    """Record of the inputs and extractor settings each output file was built from.
+
+    Stored as manifest.json in the output folder.  An output is current when the
+    file exists and both its input signatures and the extractor settings are
+    unchanged.  Entries are flushed every flush_every records so an interrupted
+    run resumes from the last flush.
+    """
+
+    def __init__(self, output_dir, settings, check="mtime", flush_every=50):
+        if check not in ("mtime", "hash"):
+            raise ValueError("Unknown manifest check: {}".format(check))
+        self.path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self._output_dir = output_dir
+        # Round trip through json so tuples compare equal to the stored lists
+        self.settings = json.loads(json.dumps(settings))
+        self.check = check
+        self._flush_every = flush_every
+        self._n_unflushed = 0
+        self.outputs = {}
+
+        manifest = None
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    manifest = json.load(f)
+            except ValueError:
+                manifest = None  # Corrupt manifest, rebuild every output
+        if manifest and manifest.get("settings") == self.settings and manifest.get("check") == check:
+            self.outputs = manifest.get("outputs", {})
+
+    def _output_key(self, output_path):
+        return os.path.relpath(output_path, self._output_dir)
+
+    def signatures(self, inputs):
+        """Return dictionary of input name -> [path, signature]"""
+        return {key: [path, file_signature(path, self.check)] for key, path in inputs.items()}
+
+    def is_current(self, output_path, signatures):
+        """Return True if output_path exists and was built from the same inputs"""
+        entry = self.outputs.get(self._output_key(output_path))
+        if entry is None or not os.path.isfile(output_path):
+            return False
+        return entry["inputs"] == json.loads(json.dumps(signatures))
+
+    def record(self, output_path, signatures):
+        """Record that output_path was built from inputs with the given signatures"""
+        self.outputs[self._output_key(output_path)] = {"inputs": signatures}
+        self._n_unflushed += 1
+        if self._n_unflushed >= self._flush_every:
+            self.flush()
+
+    def flush(self):
+        """Atomically write the manifest"""
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as f:
+            json.dump({"settings": self.settings, "check": self.check, "outputs": self.outputs}, f)
+        os.replace(tmp_path, self.path)
+        self._n_unflushed = 0
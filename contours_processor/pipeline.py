@@ -0,0 +1,163 @@
+import threading
+
+from .prefetch import queue, _ITEM, _ERROR, _END
+
+_DROPPED = object()
+
+
+class _Stage(object):
+
+    def __init__(self, func, workers, name):
+        self.func = func
+        self.workers = workers
+        self.name = name
+        self.n_running = workers
+
+
+class Pipeline(object):
+    """Run items through stages of worker threads linked by bounded queues.
+
+    Each stage applies func(item) with its own number of workers; a result of
+    None drops the item.  At most queue_size items wait between two stages and
+    at most max_in_flight items are in the pipeline, so a slow stage (or a slow
+    consumer) holds back the stages before it.  With ordered=True the results
+    come out in the order of the source.  Exceptions raised by a stage stop the
+    pipeline and are re-raised in the consumer.
+
+    Usage:
+        pipeline = Pipeline(contour_files, queue_size=16)
+        pipeline.add_stage(extract, workers=4)
+        pipeline.add_stage(validate)
+        for sample in pipeline:
+            ...
+    """
+
+    def __init__(self, source, queue_size=16, ordered=True, max_in_flight=None):
+        self._source = source
+        self._queue_size = queue_size
+        self._ordered = ordered
+        self._max_in_flight = max_in_flight
+        self._stages = []
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def add_stage(self, func, workers=1, name=None):
+        """Add a stage running func(item) in workers threads"""
+        if self._threads:
+            raise RuntimeError("Can't add stages to a running pipeline")
+        self._stages.append(_Stage(func, max(1, workers), name or getattr(func, "__name__", None)))
+        return self
+
+    def _put(self, out_queue, message):
+        """Put message in the queue.  Return False if the pipeline was stopped"""
+        while not self._stop.is_set():
+            try:
+                out_queue.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, in_queue):
+        """Return the next message of the queue, None if the pipeline was stopped"""
+        while not self._stop.is_set():
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _feed(self, out_queue, n_workers):
+        try:
+            for seq, item in enumerate(self._source):
+                while not self._in_flight.acquire(timeout=0.1):
+                    if self._stop.is_set():
+                        return
+                if not self._put(out_queue, (_ITEM, seq, item)):
+                    return
+        except Exception as e:
+            self._put(self._output, (_ERROR, None, e))
+            return
+        for _ in range(n_workers):
+            self._put(out_queue, (_END, None, None))
+
+    def _work(self, stage, in_queue, out_queue, n_next_workers):
+        while True:
+            message = self._get(in_queue)
+            if message is None:
+                return
+            kind, seq, item = message
+            if kind == _END:
+                break
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                self._put(self._output, (_ERROR, seq, e))
+                return
+            if result is None:
+                # Dropped items go straight to the output so ordering and in flight counts advance
+                if not self._put(self._output, (_ITEM, seq, _DROPPED)):
+                    return
+            elif not self._put(out_queue, (_ITEM, seq, result)):
+                return
+
+        with self._lock:
+            stage.n_running -= 1
+            last_worker = stage.n_running == 0
+        if last_worker:
+            for _ in range(n_next_workers):
+                self._put(out_queue, (_END, None, None))
+
+    def _start(self):
+        n_queues = len(self._stages) + 1
+        if self._max_in_flight is None:
+            self._max_in_flight = self._queue_size * n_queues + sum(
+                stage.workers for stage in self._stages)
+        self._in_flight = threading.BoundedSemaphore(self._max_in_flight)
+        queues = [queue.Queue(maxsize=self._queue_size) for _ in range(n_queues)]
+        self._output = queues[-1]
+
+        first_workers = self._stages[0].workers if self._stages else 1
+        self._threads.append(threading.Thread(target=self._feed, args=(queues[0], first_workers)))
+        for idx, stage in enumerate(self._stages):
+            stage.n_running = stage.workers
+            n_next_workers = self._stages[idx + 1].workers if idx + 1 < len(self._stages) else 1
+            for _ in range(stage.workers):
+                self._threads.append(threading.Thread(target=self._work,
+                    args=(stage, queues[idx], queues[idx + 1], n_next_workers)))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def __iter__(self):
+        self._start()
+        pending = {}
+        next_seq = 0
+        try:
+            while True:
+                kind, seq, item = self._output.get()
+                if kind == _ERROR:
+                    raise item
+                if kind == _END:
+                    break
+                if not self._ordered:
+                    self._in_flight.release()
+                    if item is not _DROPPED:
+                        yield item
+                    continue
+                pending[seq] = item
+                while next_seq in pending:
+                    item = pending.pop(next_seq)
+                    next_seq += 1
+                    self._in_flight.release()
+                    if item is not _DROPPED:
+                        yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the workers and drop the items in flight"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,90 @@
+import queue
+import threading
+from collections import deque
+
+
+_ITEM, _ERROR, _END = range(3)
+
+
+def ordered_map(func, iterable, executor, window):
+    """Yield func(item) for every item, keeping at most `window` items in flight.
+
+    Results are returned in the same order as the iterable even when the
+    executor completes them out of order.
+    """
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class BackgroundGenerator(object):
+    """Consume a generator in a background thread through a bounded queue.
+
+    At most `max_prefetch` items are buffered ahead of the consumer.  Exceptions
+    raised by the generator are re-raised in the consumer.  Call `close` when
+    the consumer stops early so the background thread is released.
+    """
+
+    def __init__(self, generator, max_prefetch=1):
+        self._generator = generator
+        self._queue = queue.Queue(maxsize=max(1, max_prefetch))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        """Put item in the queue.  Return False if the consumer has gone away"""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            for item in self._generator:
+                if not self._put((_ITEM, item)):
+                    break
+            else:
+                self._put((_END, None))
+        except Exception as e:
+            self._put((_ERROR, e))
+        finally:
+            close = getattr(self._generator, "close", None)
+            if close is not None:
+                close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._stop.is_set():
+            raise StopIteration
+        kind, value = self._queue.get()
+        if kind == _ITEM:
+            return value
+        self._stop.set()
+        if kind == _ERROR:
+            raise value
+        raise StopIteration
+
+    def close(self):
+        """Stop the background thread and drop any prefetched items"""
+        self._stop.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
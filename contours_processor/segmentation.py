@@ -0,0 +1,169 @@
+import numpy as np
+
+
+def batched_histograms(images, masks=None, bins=256):
+    """Return per-image histograms over each image's own value range
+
+    :param images: (n, height, width) array
+    :param masks: Optional (n, height, width) boolean array of the pixels to count
+    :return: (n, bins) counts and (n, bins) bin centers
+    """
+    n_images = len(images)
+    flat = images.reshape(n_images, -1).astype(np.float64)
+    weights = None
+    if masks is not None:
+        weights = masks.reshape(n_images, -1).astype(bool)
+        # Keep the masked out pixels out of the value range
+        low = np.where(weights, flat, np.inf).min(axis=1)
+        high = np.where(weights, flat, -np.inf).max(axis=1)
+        empty = ~weights.any(axis=1)
+        low[empty], high[empty] = 0.0, 0.0
+    else:
+        low, high = flat.min(axis=1), flat.max(axis=1)
+    span = np.where(high > low, high - low, 1.0)
+
+    bin_idx = np.clip(((flat - low[:, None]) / span[:, None] * bins).astype(np.int64), 0, bins - 1)
+    bin_idx += np.arange(n_images)[:, None] * bins
+    if weights is not None:
+        bin_idx = bin_idx[weights]
+    else:
+        bin_idx = bin_idx.ravel()
+    hist = np.bincount(bin_idx, minlength=n_images * bins).reshape(n_images, bins)
+    centers = low[:, None] + (np.arange(bins) + 0.5) * (span / bins)[:, None]
+    return hist, centers
+
+
+def otsu_thresholds(images, masks=None, bins=256):
+    """Return the Otsu threshold of each image, computed from batched histograms
+
+    Same method as skimage.filters.threshold_otsu, with the pixels outside masks
+    (when given) ignored.  Constant images get their value as threshold.
+    """
+    hist, centers = batched_histograms(images, masks, bins)
+    hist = hist.astype(np.float64)
+    weight1 = np.cumsum(hist, axis=1)
+    weight2 = np.cumsum(hist[:, ::-1], axis=1)[:, ::-1]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean1 = np.cumsum(hist * centers, axis=1) / weight1
+        mean2 = (np.cumsum((hist * centers)[:, ::-1], axis=1) / weight2[:, ::-1])[:, ::-1]
+        variance = weight1[:, :-1] * weight2[:, 1:] * (mean1[:, :-1] - mean2[:, 1:]) ** 2
+    variance = np.nan_to_num(variance)
+    thresholds = np.take_along_axis(centers, variance.argmax(axis=1)[:, None], axis=1)[:, 0]
+    # Constant images get the low end of their range, which is their value
+    constant = (hist > 0).sum(axis=1) <= 1
+    bin_width = centers[:, 1] - centers[:, 0]
+    thresholds[constant] = centers[constant, 0] - 0.5 * bin_width[constant]
+    return thresholds
+
+
+def threshold_masks(images, thresholds, masks=None):
+    """Return the (n, height, width) masks of the pixels above each image's threshold"""
+    segmented = images > np.asarray(thresholds).reshape((-1,) + (1,) * (images.ndim - 1))
+    if masks is not None:
+        segmented &= masks.astype(bool)
+    return segmented
+
+
+def _counts(predicted, target):
+    n_images = len(predicted)
+    predicted = predicted.reshape(n_images, -1).astype(bool)
+    target = target.reshape(n_images, -1).astype(bool)
+    intersection = np.count_nonzero(predicted & target, axis=1)
+    return intersection, np.count_nonzero(predicted, axis=1), np.count_nonzero(target, axis=1)
+
+
+def iou_scores(predicted, target):
+    """Return the intersection over union of each pair of masks, 1 when both are empty"""
+    intersection, n_predicted, n_target = _counts(predicted, target)
+    union = n_predicted + n_target - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1), 1.0)
+
+
+def dice_scores(predicted, target):
+    """Return the Dice coefficient of each pair of masks, 1 when both are empty"""
+    intersection, n_predicted, n_target = _counts(predicted, target)
+    total = n_predicted + n_target
+    return np.where(total > 0, 2 * intersection / np.maximum(total, 1), 1.0)
+
+
+def score_batch(images, target, masks=None, bins=256):
+    """Threshold the images with Otsu and score the segmentation against target
+
+    :param images: (n, height, width) images (ex: the DICOMs)
+    :param target: (n, height, width) expected masks (ex: the i-contours)
+    :param masks: Optional (n, height, width) region to threshold (ex: the o-contours)
+    :return: Dictionary of per-image "threshold", "iou" and "dice" arrays
+    """
+    thresholds = otsu_thresholds(images, masks, bins)
+    predicted = threshold_masks(images, thresholds, masks)
+    return {
+        "threshold": thresholds,
+        "iou": iou_scores(predicted, target),
+        "dice": dice_scores(predicted, target),
+    }
+
+
+class CohortStats(object):
+    """Streaming count, mean, standard deviation, min and max of per-image metrics.
+
+    Uses the parallel variant of Welford's algorithm so batches (or the stats of
+    other workers, see merge) are folded in without keeping the per-image values.
+    """
+
+    def __init__(self):
+        self._stats = {}
+
+    def update(self, metrics):
+        """Add a batch of per-image metrics: dictionary of name -> 1d array"""
+        for name, values in metrics.items():
+            values = np.asarray(values, dtype=np.float64)
+            if len(values) == 0:
+                continue
+            self._combine(name, len(values), values.mean(), ((values - values.mean()) ** 2).sum(),
+                values.min(), values.max())
+
+    def _combine(self, name, count, mean, m2, minimum, maximum):
+        stats = self._stats.get(name)
+        if stats is None:
+            self._stats[name] = [count, mean, m2, minimum, maximum]
+            return
+        total = stats[0] + count
+        delta = mean - stats[1]
+        stats[1] += delta * count / total
+        stats[2] += m2 + delta ** 2 * stats[0] * count / total
+        stats[0] = total
+        stats[3] = min(stats[3], minimum)
+        stats[4] = max(stats[4], maximum)
+
+    def merge(self, other):
+        """Fold the stats of another CohortStats in"""
+        for name, stats in other._stats.items():
+            self._combine(name, *stats)
+
+    def summary(self):
+        """Return dictionary of name -> count, mean, std, min and max"""
+        return {name: {"count": int(count), "mean": float(mean), "std": float(np.sqrt(m2 / count)),
+                       "min": float(minimum), "max": float(maximum)}
+                for name, (count, mean, m2, minimum, maximum) in self._stats.items()}
+
+
+def score_dataset(contour_dataset, batch_size=32, bins=256, cohort_stats=None):
+    """Score the Otsu threshold segmentation over a whole ContourDataset, batch by batch
+
+    The x channels are either the images or [images, region] (ex: ["dicom",
+    "o-contours"]) and the y channel the expected masks (ex: "i-contours").  Only
+    one batch is in memory at a time.
+
+    :return: CohortStats of the threshold, iou and dice of every image
+    """
+    if cohort_stats is None:
+        cohort_stats = CohortStats()
+    for batch in contour_dataset.generate_batch(batch_size=batch_size, shuffle=False):
+        x_batch, y_batch = batch[-2:]
+        if len(x_batch) == 0:
+            continue
+        masks = None
+        if x_batch.ndim == 4:
+            x_batch, masks = x_batch[:, 0], x_batch[:, 1] != 0
+        cohort_stats.update(score_batch(x_batch, y_batch, masks, bins))
+    return cohort_stats
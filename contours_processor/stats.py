@@ -0,0 +1,157 @@
+import time
+import threading
+from bisect import bisect_left
+
+# Upper bounds (in seconds) of the timing histogram buckets, the last bucket is unbounded
+TIMING_BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullStats(object):
+    """Stats that record nothing, used when instrumentation is disabled"""
+
+    enabled = False
+
+    def timer(self, stage):
+        return _NULL_TIMER
+
+    def observe(self, stage, seconds):
+        pass
+
+    def incr(self, name, value=1):
+        pass
+
+    def merge(self, snapshot):
+        pass
+
+    def reset(self):
+        pass
+
+    def snapshot(self):
+        return {"counters": {}, "timings": {}, "buckets": list(TIMING_BUCKETS)}
+
+
+class _Timer(object):
+
+    def __init__(self, stats, stage):
+        self._stats = stats
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stats.observe(self._stage, time.perf_counter() - self._start)
+        return False
+
+
+class PipelineStats(object):
+    """Per-stage wall time histograms and counters of the extraction pipeline.
+
+    Stages are timed with `with stats.timer("dicom_decode"): ...` and counters
+    incremented with stats.incr("files_processed").  snapshot() returns a JSON
+    serialisable dictionary of the counters and per-stage count, total, min,
+    max, mean and histogram bucket counts (see TIMING_BUCKETS).
+
+    callback(kind, name, value) is called with ("timing", stage, seconds) and
+    ("counter", name, increment) for every event, to forward them to a metrics
+    system.  Events recorded in worker processes are only merged into the
+    snapshot, they don't reach the callback.
+    """
+
+    enabled = True
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["callback"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Clear all the counters and timings"""
+        with self._lock:
+            self._counters = {}
+            self._timings = {}
+
+    def timer(self, stage):
+        """Return context manager recording its wall time in the stage histogram"""
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        """Record a stage wall time in seconds"""
+        with self._lock:
+            timing = self._timings.get(stage)
+            if timing is None:
+                timing = self._timings[stage] = {"count": 0, "total": 0.0, "min": seconds,
+                    "max": seconds, "buckets": [0] * (len(TIMING_BUCKETS) + 1)}
+            timing["count"] += 1
+            timing["total"] += seconds
+            timing["min"] = min(timing["min"], seconds)
+            timing["max"] = max(timing["max"], seconds)
+            timing["buckets"][bisect_left(TIMING_BUCKETS, seconds)] += 1
+        if self.callback is not None:
+            self.callback("timing", stage, seconds)
+
+    def incr(self, name, value=1):
+        """Increment the counter name by value"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        if self.callback is not None:
+            self.callback("counter", name, value)
+
+    def merge(self, snapshot):
+        """Add the counters and timings of another snapshot (ex: from a worker process)"""
+        with self._lock:
+            for name, value in snapshot["counters"].items():
+                self._counters[name] = self._counters.get(name, 0) + value
+            for stage, other in snapshot["timings"].items():
+                timing = self._timings.get(stage)
+                if timing is None:
+                    self._timings[stage] = {key: other[key] if key != "buckets" else list(other[key])
+                        for key in ("count", "total", "min", "max", "buckets")}
+                    continue
+                timing["count"] += other["count"]
+                timing["total"] += other["total"]
+                timing["min"] = min(timing["min"], other["min"])
+                timing["max"] = max(timing["max"], other["max"])
+                timing["buckets"] = [count + other_count for count, other_count
+                    in zip(timing["buckets"], other["buckets"])]
+
+    def snapshot(self):
+        """Return dictionary of counters, timings per stage and the bucket upper bounds"""
+        with self._lock:
+            timings = {}
+            for stage, timing in self._timings.items():
+                timings[stage] = dict(timing, buckets=list(timing["buckets"]),
+                    mean=timing["total"] / timing["count"])
+            return {"counters": dict(self._counters), "timings": timings,
+                "buckets": list(TIMING_BUCKETS)}
+
+
+def _call_collecting_stats(func, *args):
+    """Run func in a worker process and return its result with the stats it recorded"""
+    stats = func.__self__.stats
+    stats.reset()
+    result = func(*args)
+    return result, stats.snapshot()
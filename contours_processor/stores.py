@@ -0,0 +1,420 @@
+import os.path
+import json
+import struct
+from glob import glob
+import numpy as np
+
+from .exceptions import InvalidDatasetError
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+
+class PackedDatasetWriter(object):
+    """Append Datasets and Sources into a single (or sharded) HDF5 file.
+
+    Every channel is stored as one stacked dataset of shape (n_samples, height, width),
+    chunked one sample per chunk so random samples can be read without
+    decompressing their neighbours.  Sources are kept as string columns in the
+    "sources" group and "metadata/present" records which channels each sample has.
+    The shape and dtype of a channel are set by its first sample; later samples
+    must have the same shape and a dtype that casts to it without loss.
+    """
+
+    def __init__(self, output_dir, name="contours-dataset", shard_size=None):
+        """Create a writer for output_dir/name.h5 or name-00000.h5, ... when sharded
+
+        :param shard_size: Maximum number of samples per file.  Default to None (single file)
+        """
+        self._output_dir = output_dir
+        self._name = name
+        self._shard_size = shard_size
+        self._shard_idx = 0
+        self._file = None
+        self._n_samples = 0
+        self.filenames = []
+
+    def _shard_filename(self):
+        if self._shard_size:
+            filename = "{}-{:05d}.h5".format(self._name, self._shard_idx)
+        else:
+            filename = "{}.h5".format(self._name)
+        return os.path.join(self._output_dir, filename)
+
+    def _open_shard(self):
+        filename = self._shard_filename()
+        import h5py
+        try:
+            self._file = h5py.File(filename, "w")
+        except Exception:
+            raise InvalidDatasetError("Error Saving Datasets File: {}".format(filename))
+        self._file.create_group("sources")
+        metadata = self._file.create_group("metadata")
+        metadata.create_dataset("present", (0, 0), maxshape=(None, None), dtype=bool,
+            chunks=(1024, 16))
+        metadata.attrs["_data_keys"] = ""
+        self._n_samples = 0
+        self.filenames.append(filename)
+
+    def _data_keys(self):
+        data_keys = self._file["metadata"].attrs["_data_keys"]
+        return [key for key in _decode(data_keys).split(",") if key]
+
+    def _add_channel(self, key, dataset):
+        """Create the stacked dataset for a channel seen for the first time"""
+        self._file.create_dataset(key,
+                                  (self._n_samples,) + dataset.shape,
+                                  maxshape=(None,) + dataset.shape,
+                                  chunks=(1,) + dataset.shape,
+                                  dtype=dataset.dtype)
+        data_keys = self._data_keys() + [key]
+        self._file["metadata"].attrs["_data_keys"] = ",".join(data_keys)
+        present = self._file["metadata/present"]
+        present.resize((self._n_samples, len(data_keys)))
+
+    def _add_source(self, key):
+        import h5py
+        self._file["sources"].create_dataset(key, (self._n_samples,), maxshape=(None,),
+            dtype=h5py.special_dtype(vlen=str), chunks=(1024,))
+
+    def append(self, datasets, sources=None):
+        """Append one sample's Datasets and Sources"""
+        if sources is None:
+            sources = {}
+        if self._file is None:
+            self._open_shard()
+
+        for key, dataset in datasets.items():
+            if key not in self._file:
+                self._add_channel(key, dataset)
+            elif self._file[key].shape[1:] != dataset.shape:
+                raise InvalidDatasetError("Shape of {} doesn't match the packed datasets in {}".format(
+                    key, self._file.filename))
+            elif not np.can_cast(dataset.dtype, self._file[key].dtype, "safe"):
+                raise InvalidDatasetError("Dtype {} of {} doesn't fit the packed {} datasets in {}".format(
+                    dataset.dtype, key, self._file[key].dtype, self._file.filename))
+        for key in sources:
+            if key not in self._file["sources"]:
+                self._add_source(key)
+
+        idx = self._n_samples
+        self._n_samples += 1
+        data_keys = self._data_keys()
+        present = self._file["metadata/present"]
+        present.resize((self._n_samples, len(data_keys)))
+        present[idx] = [key in datasets for key in data_keys]
+        for key in data_keys:
+            self._file[key].resize(self._n_samples, axis=0)
+            if key in datasets:
+                self._file[key][idx] = datasets[key]
+        for key, source_column in self._file["sources"].items():
+            source_column.resize((self._n_samples,))
+            source_column[idx] = str(sources.get(key, ""))
+
+        if self._shard_size and self._n_samples >= self._shard_size:
+            self._file.close()
+            self._file = None
+            self._shard_idx += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PackedDatasetReader(object):
+    """Read random samples in bulk from packed HDF5 files.
+
+    Accepts a single file, a glob pattern or a list of shard files.  Samples are
+    numbered across shards in the sorted order of the filenames.
+    """
+
+    def __init__(self, path):
+        if isinstance(path, (list, tuple)):
+            filenames = list(path)
+        else:
+            filenames = sorted(glob(path))
+        if not filenames:
+            raise InvalidDatasetError("No packed dataset files found: {}".format(path))
+
+        import h5py
+        self.filenames = filenames
+        self._files = [None] * len(filenames)
+        shard_sizes = []
+        self.data_keys = []
+        for filename in filenames:
+            try:
+                with h5py.File(filename, "r") as f:
+                    shard_sizes.append(f["metadata/present"].shape[0])
+                    data_keys = _decode(f["metadata"].attrs["_data_keys"]).split(",")
+            except Exception:
+                raise InvalidDatasetError("Error Processing File: {}".format(filename))
+            for key in data_keys:
+                if key and key not in self.data_keys:
+                    self.data_keys.append(key)
+        self._offsets = np.concatenate([[0], np.cumsum(shard_sizes)]).astype(np.int64)
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def _file(self, shard_idx):
+        if self._files[shard_idx] is None:
+            import h5py
+            self._files[shard_idx] = h5py.File(self.filenames[shard_idx], "r")
+        return self._files[shard_idx]
+
+    def _shard_rows(self, indices):
+        """Yield (shard_idx, positions in indices, sorted unique rows) per shard"""
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_ids = np.searchsorted(self._offsets, indices, side="right") - 1
+        for shard_idx in np.unique(shard_ids):
+            positions = np.nonzero(shard_ids == shard_idx)[0]
+            rows = indices[positions] - self._offsets[shard_idx]
+            yield shard_idx, positions, rows
+
+    def sample_name(self, idx):
+        """Return "filename[row]" identifying the sample at idx"""
+        shard_idx = int(np.searchsorted(self._offsets, idx, side="right") - 1)
+        return "{}[{}]".format(self.filenames[shard_idx], idx - self._offsets[shard_idx])
+
+    def read(self, indices, keys=None):
+        """Return (datasets, present) for the samples at indices.
+
+        :param indices: Sequence of sample indices, in any order
+        :param keys: Channels to read.  Default to None (all channels)
+        :return: Dictionary of channel -> array of shape (len(indices), height, width)
+            and dictionary of channel -> boolean array of samples having the channel
+        """
+        if keys is None:
+            keys = self.data_keys
+        datasets, present = {}, {}
+        for shard_idx, positions, rows in self._shard_rows(indices):
+            f = self._file(shard_idx)
+            # h5py needs increasing, unique indices for fancy selection
+            unique_rows, inverse = np.unique(rows, return_inverse=True)
+            shard_keys = _decode(f["metadata"].attrs["_data_keys"]).split(",")
+            shard_present = f["metadata/present"][unique_rows.tolist()]
+            for key in keys:
+                if key not in f:
+                    continue
+                stacked = f[key]
+                if key not in datasets:
+                    datasets[key] = np.zeros((len(indices),) + stacked.shape[1:], dtype=stacked.dtype)
+                    present[key] = np.zeros(len(indices), dtype=bool)
+                datasets[key][positions] = stacked[unique_rows.tolist()][inverse]
+                present[key][positions] = shard_present[inverse, shard_keys.index(key)]
+        return datasets, present
+
+    def sources(self, indices):
+        """Return list of Sources dictionaries for the samples at indices"""
+        sources = [None] * len(indices)
+        for shard_idx, positions, rows in self._shard_rows(indices):
+            f = self._file(shard_idx)
+            unique_rows, inverse = np.unique(rows, return_inverse=True)
+            columns = {key: column[unique_rows.tolist()] for key, column in f["sources"].items()}
+            for position, row, row_idx in zip(positions, rows, inverse):
+                sample_sources = {key: _decode(values[row_idx]) for key, values in columns.items()}
+                sample_sources = {key: value for key, value in sample_sources.items() if value}
+                sample_sources["filename"] = "{}[{}]".format(self.filenames[shard_idx], row)
+                sources[position] = sample_sources
+        return sources
+
+    def close(self):
+        for idx, f in enumerate(self._files):
+            if f is not None:
+                f.close()
+                self._files[idx] = None
+
+
+_NPY_HEADER_SIZE = 128
+NPY_INDEX_FILENAME = "index.json"
+
+
+def _npy_header(dtype, shape):
+    """Return a fixed size .npy (version 1.0) header so it can be rewritten in place"""
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    prefix = b"\x93NUMPY\x01\x00"
+    header_len = _NPY_HEADER_SIZE - len(prefix) - 2
+    if len(header) >= header_len:
+        raise ValueError("Shape {} doesn't fit in the .npy header".format(shape))
+    header = header.ljust(header_len - 1) + "\n"
+    return prefix + struct.pack("<H", header_len) + header.encode("latin1")
+
+
+class NpyDatasetWriter(object):
+    """Write Datasets as fixed-shape raw .npy blocks plus an index.
+
+    Each channel is appended to output_dir/<channel>.npy with shape
+    (n_samples, height, width).  On close the .npy headers are updated with the
+    final number of samples and index.json records the channels, their presence
+    per sample (present.npy) and the Sources of every sample.  As with
+    PackedDatasetWriter, later samples must keep the shape of the first one and
+    have a dtype that casts to its dtype without loss.
+    """
+
+    def __init__(self, output_dir):
+        self._output_dir = output_dir
+        self._files = {}
+        self._layouts = {}
+        self._n_samples = 0
+        self._present = []
+        self._sources = []
+
+    def _channel_path(self, key):
+        return os.path.join(self._output_dir, "{}.npy".format(key))
+
+    def _add_channel(self, key, dataset):
+        layout = (dataset.shape, dataset.dtype)
+        f = open(self._channel_path(key), "wb")
+        f.write(_npy_header(dataset.dtype, (0,) + dataset.shape))
+        # Samples written before this channel was seen are zero filled
+        f.write(np.zeros(dataset.shape, dtype=dataset.dtype).tobytes() * self._n_samples)
+        self._files[key] = f
+        self._layouts[key] = layout
+
+    def append(self, datasets, sources=None):
+        """Append one sample's Datasets and Sources"""
+        for key, dataset in datasets.items():
+            if key not in self._files:
+                self._add_channel(key, dataset)
+            elif dataset.shape != self._layouts[key][0]:
+                raise InvalidDatasetError("Shape of {} doesn't match the datasets in {}".format(
+                    key, self._output_dir))
+            elif not np.can_cast(dataset.dtype, self._layouts[key][1], "safe"):
+                raise InvalidDatasetError("Dtype {} of {} doesn't fit the {} datasets in {}".format(
+                    dataset.dtype, key, self._layouts[key][1], self._output_dir))
+
+        for key, f in self._files.items():
+            shape, dtype = self._layouts[key]
+            if key in datasets:
+                data = np.ascontiguousarray(datasets[key], dtype=dtype)
+            else:
+                data = np.zeros(shape, dtype=dtype)
+            f.write(data.tobytes())
+        self._present.append(set(datasets))
+        self._sources.append({key: str(value) for key, value in (sources or {}).items()})
+        self._n_samples += 1
+
+    def close(self):
+        if self._files is None:
+            return
+        data_keys = list(self._files)
+        for key, f in self._files.items():
+            shape, dtype = self._layouts[key]
+            f.seek(0)
+            f.write(_npy_header(dtype, (self._n_samples,) + shape))
+            f.close()
+        present = np.array([[key in sample_keys for key in data_keys]
+            for sample_keys in self._present], dtype=bool).reshape(self._n_samples, len(data_keys))
+        np.save(os.path.join(self._output_dir, "present.npy"), present)
+        index = {
+            "n_samples": self._n_samples,
+            "data_keys": data_keys,
+            "sources": self._sources,
+        }
+        # The index is written last, a folder without it is an incomplete export
+        with open(os.path.join(self._output_dir, NPY_INDEX_FILENAME), "w") as f:
+            json.dump(index, f)
+        self._files = None
+
+    def _abort(self):
+        """Close the channel files without writing the index, leaving an incomplete export"""
+        if self._files is None:
+            return
+        for f in self._files.values():
+            f.close()
+        self._files = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+
+class NpyDatasetReader(object):
+    """Read samples from a folder written by NpyDatasetWriter through np.memmap.
+
+    The channel arrays are memory mapped read-only, so processes reading the same
+    folder share the OS page cache.  Contiguous reads are returned as views.
+    """
+
+    def __init__(self, folder):
+        index_path = os.path.join(folder, NPY_INDEX_FILENAME)
+        try:
+            with open(index_path, "r") as f:
+                index = json.load(f)
+            self._arrays = {key: np.load(os.path.join(folder, "{}.npy".format(key)), mmap_mode="r")
+                for key in index["data_keys"]}
+            self._present = np.load(os.path.join(folder, "present.npy"))
+        except (IOError, OSError, ValueError, KeyError):
+            raise InvalidDatasetError("Error Processing File: {}".format(index_path))
+        self.folder = folder
+        self.filenames = [index_path]
+        self.data_keys = index["data_keys"]
+        self._sources = index["sources"]
+        self._n_samples = index["n_samples"]
+
+    def __len__(self):
+        return self._n_samples
+
+    def sample_name(self, idx):
+        """Return "folder[idx]" identifying the sample at idx"""
+        return "{}[{}]".format(self.folder, idx)
+
+    def read(self, indices, keys=None):
+        """Return (datasets, present) for the samples at indices.
+
+        :param indices: Sequence of sample indices, in any order
+        :param keys: Channels to read.  Default to None (all channels)
+        :return: Dictionary of channel -> array of shape (len(indices), height, width)
+            and dictionary of channel -> boolean array of samples having the channel
+        """
+        if keys is None:
+            keys = self.data_keys
+        indices = np.asarray(indices, dtype=np.int64)
+        contiguous = len(indices) > 0 and np.array_equal(
+            indices, np.arange(indices[0], indices[0] + len(indices)))
+        datasets, present = {}, {}
+        for key in keys:
+            if key not in self._arrays:
+                continue
+            array = self._arrays[key]
+            if contiguous:
+                datasets[key] = array[indices[0]:indices[0] + len(indices)]
+            else:
+                datasets[key] = array[indices]
+            present[key] = self._present[indices, self.data_keys.index(key)]
+        return datasets, present
+
+    def sources(self, indices):
+        """Return list of Sources dictionaries for the samples at indices"""
+        sources = []
+        for idx in indices:
+            sample_sources = dict(self._sources[idx])
+            sample_sources["filename"] = self.sample_name(idx)
+            sources.append(sample_sources)
+        return sources
+
+    def close(self):
+        self._arrays = {}
+
+
+def open_store(path):
+    """Return the reader for a packed HDF5 store or a .npy store folder"""
+    if not isinstance(path, (list, tuple)) and os.path.isfile(os.path.join(path, NPY_INDEX_FILENAME)):
+        return NpyDatasetReader(path)
+    return PackedDatasetReader(path)
@@ -0,0 +1,65 @@
+from __future__ import absolute_import, division
+
+import numpy as np
+import pytest
+from contours_processor import ContourFileExtractor
+
+FOLDER_MAP = {"SC-HF-I-1": "SCD0000101", "SC-HF-I-2": "SCD0000201"}
+SLICES = (20, 40, 60)
+IMAGE_SIZE = 32
+
+
+class NpyDicomExtractor(ContourFileExtractor):
+    """ContourFileExtractor reading the .dcm test files as .npy pixel arrays"""
+
+    def _decode_dicom_file(self, filename):
+        return np.load(filename), (1.0, 0.0)
+
+    def _read_dicom_rescale(self, filename):
+        return 1.0, 0.0
+
+
+def write_dicom(filename, slice_idx):
+    """Write the pixels of a synthetic slice, its values depend on the slice"""
+    pixels = np.arange(IMAGE_SIZE * IMAGE_SIZE, dtype=np.int16).reshape(IMAGE_SIZE, IMAGE_SIZE)
+    with open(str(filename), "wb") as f:
+        np.save(f, pixels + slice_idx)
+
+
+def write_contour(filename, offset):
+    """Write a square contour, offset pixels inside the image"""
+    corners = [(offset, offset), (IMAGE_SIZE - offset, offset),
+               (IMAGE_SIZE - offset, IMAGE_SIZE - offset), (offset, IMAGE_SIZE - offset)]
+    filename.write("".join("{:.2f} {:.2f}\n".format(x, y) for x, y in corners), ensure=True)
+
+
+@pytest.fixture
+def contour_folders(tmpdir, monkeypatch):
+    """Synthetic contour and dicom folders, with relative paths from tmpdir
+
+    :return: (contour_top_folder, dicom_top_folder, contour_dicom_folder_map)
+    """
+    # The extractor rebuilds paths from their "/" separated parts, keep them relative
+    monkeypatch.chdir(tmpdir)
+    for contour_folder, dicom_folder in FOLDER_MAP.items():
+        tmpdir.join("dicoms", dicom_folder).ensure(dir=True)
+        for slice_idx in SLICES:
+            write_dicom(tmpdir.join("dicoms", dicom_folder, "{}.dcm".format(slice_idx)), slice_idx)
+            for contour_type, offset in (("o", 4), ("i", 8)):
+                write_contour(tmpdir.join("contours", contour_folder,
+                    "{}-contours".format(contour_type),
+                    "IM-0001-{:04d}-{}contour-manual.txt".format(slice_idx, contour_type)), offset)
+    return "contours/", "dicoms/", dict(FOLDER_MAP)
+
+
+@pytest.fixture
+def make_extractor(contour_folders):
+    """Return a function creating NpyDicomExtractors over the synthetic folders"""
+    contour_root, dicom_root, folder_map = contour_folders
+
+    def make(**kwargs):
+        kwargs.setdefault("secondary_contours", ["i-contours"])
+        kwargs.setdefault("target_size", (IMAGE_SIZE, IMAGE_SIZE))
+        return NpyDicomExtractor(contour_root, dicom_root,
+            contour_dicom_folder_map=folder_map, **kwargs)
+    return make
@@ -0,0 +1,82 @@
+from __future__ import absolute_import, division
+
+import asyncio
+import os
+
+import numpy.testing as npt
+from contours_processor import aio
+from contours_processor.utils import load_dataset
+
+
+async def _collect(async_iterator):
+    return [item async for item in async_iterator]
+
+
+def test_datasets_generator_async(make_extractor):
+    """
+    Testing async datasets match the serial generator, ordered or not"""
+    extractor = make_extractor()
+    expected = list(extractor.datasets_generator())
+
+    # Every input is resolved once, when its files are fetched
+    resolved = []
+    contour_file_inputs = extractor._contour_file_inputs
+
+    def counting_inputs(contour_path):
+        resolved.append(contour_path)
+        return contour_file_inputs(contour_path)
+    extractor._contour_file_inputs = counting_inputs
+
+    results = asyncio.run(_collect(extractor.datasets_generator_async(concurrency=2)))
+    assert [sources for _, sources in results] == [sources for _, sources in expected]
+    for (datasets, _), (expected_datasets, _) in zip(results, expected):
+        assert sorted(datasets) == sorted(expected_datasets)
+        for key in datasets:
+            npt.assert_array_equal(datasets[key], expected_datasets[key])
+    assert sorted(resolved) == sorted(sources["o-contours"] for _, sources in expected)
+
+    results = asyncio.run(_collect(extractor.datasets_generator_async(concurrency=3,
+        ordered=False)))
+    assert sorted(sources["dicom"] for _, sources in results) == sorted(
+        sources["dicom"] for _, sources in expected)
+
+
+def test_save_datasets_async(make_extractor, tmpdir):
+    """
+    Testing async saving writes the same files as save_datasets"""
+    extractor = make_extractor()
+    serial_dir, async_dir = str(tmpdir.mkdir("serial")), str(tmpdir.mkdir("async"))
+    assert extractor.save_datasets(serial_dir) == {"saved": 6, "skipped": 0, "failed": 0}
+    summary = asyncio.run(extractor.save_datasets_async(async_dir, concurrency=4))
+    assert summary == {"saved": 6, "skipped": 0, "failed": 0}
+    assert asyncio.run(extractor.save_datasets_async(str(tmpdir.mkdir("first")),
+        n_samples=2))["saved"] == 2
+
+    assert sorted(os.listdir(async_dir)) == sorted(os.listdir(serial_dir))
+    for filename in os.listdir(serial_dir):
+        datasets, _ = load_dataset(os.path.join(async_dir, filename))
+        expected, _ = load_dataset(os.path.join(serial_dir, filename))
+        for key in expected:
+            npt.assert_array_equal(datasets[key], expected[key])
+
+
+def test_map_contour_files_aclose(make_extractor):
+    """
+    Testing an early aclose stops scheduling the remaining contour files"""
+    extractor = make_extractor()
+    contour_files = list(extractor._get_contour_files(False)) * 20
+    processed = []
+
+    def process(contour_path, file_bytes, inputs):
+        processed.append(contour_path)
+        return contour_path
+
+    async def first_result():
+        results = aio.map_contour_files(extractor, process, contour_files, concurrency=2)
+        first = await results.__anext__()
+        await results.aclose()
+        return first
+
+    assert asyncio.run(first_result()) == contour_files[0]
+    # At most the 2 * concurrency contour files in flight were processed
+    assert len(processed) <= 4
@@ -0,0 +1,27 @@
+from __future__ import absolute_import, division
+
+import numpy as np
+from contours_processor.cache import DicomCache
+
+
+def test_dicom_cache(tmpdir):
+    """
+    Testing memory LRU eviction and the on-disk tier"""
+    filenames = []
+    for idx in range(3):
+        filename = tmpdir.join("{}.dcm".format(idx))
+        filename.write("dicom")
+        filenames.append(str(filename))
+
+    def loader(filename):
+        return np.zeros((8, 8), dtype=np.int16)
+
+    cache = DicomCache(max_bytes=2 * 128, cache_dir=str(tmpdir.join("cache")))
+    for filename in filenames + filenames[-1:]:
+        cache.get(filename, loader)
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits"], stats["entries"]) == (3, 1, 2)
+
+    # The evicted first file comes back from disk
+    assert not cache.get(filenames[0], loader).flags.writeable
+    assert cache.stats()["disk_hits"] == 1
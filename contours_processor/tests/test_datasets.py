@@ -0,0 +1,173 @@
+from __future__ import absolute_import, division
+
+import multiprocessing
+import threading
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+from contours_processor import ContourDataset
+from contours_processor.features import DERIVED_CHANNELS, add_derived_channels, register_channel
+from contours_processor.stores import NpyDatasetWriter
+from contours_processor.utils import dump_dataset
+
+
+def _samples(n_samples):
+    for idx in range(n_samples):
+        dataset = {"dicom": np.full((4, 4), idx, dtype=np.int16),
+                   "o-contours": np.zeros((4, 4), dtype=bool)}
+        yield dataset, {"filename": str(idx)}
+
+
+def _sample_ids(dset):
+    return [int(filename) for sources, _, _ in dset.generate_batch(batch_size=4)
+            for filename in (source["filename"] for source in sources)]
+
+
+def test_sharded_generator():
+    """
+    Testing disjoint shards and epoch shuffling of generator samples"""
+    shards = []
+    for shard_index in range(3):
+        dset = ContourDataset("dicom", "o-contours", include_sources=True,
+            contour_dicom_generator=_samples(20), num_shards=3, shard_index=shard_index,
+            seed=7, shuffle_buffer=4)
+        shards.append(_sample_ids(dset))
+    assert sorted(sum(shards, [])) == list(range(20))
+    assert shards[0] != sorted(shards[0])
+
+    # Same seed and epoch give the same order, a new epoch reshuffles
+    orders = []
+    for epoch in (0, 0, 1):
+        dset = ContourDataset("dicom", "o-contours", include_sources=True,
+            contour_dicom_generator=_samples(20), seed=7, shuffle_buffer=8)
+        dset.set_epoch(epoch)
+        orders.append(_sample_ids(dset))
+    assert orders[0] == orders[1] != orders[2]
+
+
+def _mixed_dtype_samples():
+    yield {"dicom": np.full((4, 4), 3, dtype=np.int16),
+           "o-contours": np.zeros((4, 4), dtype=bool)}, {"filename": "0"}
+    yield {"dicom": np.full((4, 4), 40000.5), "o-contours": np.ones((4, 4), dtype=bool)}, \
+        {"filename": "1"}
+
+
+def test_batch_dtype_promotion():
+    """
+    Testing that batches without a requested dtype don't truncate later samples"""
+    for target_size in (None, (4, 4)):
+        dset = ContourDataset("dicom", "o-contours", contour_dicom_generator=_mixed_dtype_samples(),
+            target_size=target_size)
+        x_batch, y_batch = next(dset.generate_batch(batch_size=2))
+        assert x_batch.dtype == np.float64
+        assert (x_batch[:, 0, 0] == [3, 40000.5]).all()
+        assert y_batch.dtype == bool
+
+
+def _write_folder(tmpdir, n_samples=10):
+    folder = tmpdir.mkdir("processed")
+    for idx in range(n_samples):
+        dump_dataset(str(folder.join("{:02d}.h5".format(idx))),
+            {"dicom": np.full((4, 4), idx, dtype=np.int16),
+             "o-contours": np.eye(4, dtype=bool)})
+    return str(folder)
+
+
+def _batches(dset, **kwargs):
+    return [(sources, x_batch, y_batch) for sources, x_batch, y_batch
+            in dset.generate_batch(batch_size=4, shuffle=False, **kwargs)]
+
+
+def test_prefetch_order(tmpdir):
+    """
+    Testing prefetched batches, loaded by threads or processes, keep the serial order"""
+    dset = ContourDataset("dicom", "o-contours", include_sources=True,
+        contour_dicom_folder=_write_folder(tmpdir), target_size=None)
+    expected = _batches(dset)
+    assert [len(sources) for sources, _, _ in expected] == [4, 4, 2]
+    for kwargs in ({"prefetch": 2}, {"prefetch": 1, "workers": 3},
+                   {"prefetch": 2, "workers": 2, "worker_type": "process"}):
+        batches = _batches(dset, **kwargs)
+        assert len(batches) == len(expected)
+        for (sources, x_batch, y_batch), (exp_sources, exp_x, exp_y) in zip(batches, expected):
+            assert [source["filename"] for source in sources] == [
+                source["filename"] for source in exp_sources]
+            npt.assert_array_equal(x_batch, exp_x)
+            npt.assert_array_equal(y_batch, exp_y)
+
+
+def test_prefetch_early_close(tmpdir):
+    """
+    Testing the background thread and the loading pool are released on close"""
+    dset = ContourDataset("dicom", "o-contours", contour_dicom_folder=_write_folder(tmpdir),
+        target_size=None)
+    threads = set(threading.enumerate())
+    for worker_type in ("thread", "process"):
+        batches = dset.generate_batch(batch_size=2, prefetch=2, workers=2, worker_type=worker_type)
+        next(batches)
+        batches.close()
+        assert set(threading.enumerate()) <= threads
+        assert multiprocessing.active_children() == []
+
+
+def test_reuse_buffers_and_dtypes(tmpdir):
+    """
+    Testing reused batch arrays and the requested batch dtypes"""
+    folder = _write_folder(tmpdir, n_samples=12)
+    dset = ContourDataset("dicom", "o-contours", contour_dicom_folder=folder, target_size=None)
+    expected = [(x_batch, y_batch) for x_batch, y_batch
+                in dset.generate_batch(batch_size=4, shuffle=False)]
+    batches = []
+    for x_batch, y_batch in dset.generate_batch(batch_size=4, shuffle=False, reuse_buffers=2):
+        batches.append((x_batch, y_batch))
+        npt.assert_array_equal(x_batch, expected[len(batches) - 1][0])
+    # The ring of 2 arrays is reused every other batch
+    assert np.shares_memory(batches[0][0], batches[2][0])
+    assert not np.shares_memory(batches[0][0], batches[1][0])
+    with pytest.raises(ValueError):
+        next(dset.generate_batch(batch_size=4, prefetch=1, reuse_buffers=2))
+
+    for target_size in (None, (6, 6)):
+        dset = ContourDataset("dicom", "o-contours", contour_dicom_folder=folder,
+            x_dtype=np.float32, y_dtype=np.uint8, target_size=target_size)
+        for x_batch, y_batch in dset.generate_batch(batch_size=5, reuse_buffers=3):
+            assert x_batch.dtype == np.float32
+            assert y_batch.dtype == np.uint8
+
+
+def test_stale_derived_channel_in_store(tmpdir):
+    """
+    Testing a stored derived channel of another version is recomputed without sources"""
+    channel = register_channel("test-doubled", ("dicom",), lambda dicom: dicom * 2)
+    try:
+        with NpyDatasetWriter(str(tmpdir)) as writer:
+            for dataset, sources in _samples(4):
+                add_derived_channels(["test-doubled"], dataset, sources)
+                writer.append(dataset, sources)
+
+        channel.version = 2
+        channel.func = lambda dicom: dicom * 3
+        dset = ContourDataset("test-doubled", "o-contours", contour_dicom_store=str(tmpdir),
+            target_size=None)
+        x_batch, _ = next(dset.generate_batch(batch_size=4))
+        npt.assert_array_equal(np.sort(x_batch[:, 0, 0]), [0, 3, 6, 9])
+    finally:
+        del DERIVED_CHANNELS["test-doubled"]
+
+
+def test_sharded_store_lengths(tmpdir):
+    """
+    Testing store shards are padded to the same length"""
+    with NpyDatasetWriter(str(tmpdir)) as writer:
+        for dataset, sources in _samples(10):
+            writer.append(dataset, sources)
+    shards = []
+    for shard_index in range(4):
+        dset = ContourDataset("dicom", "o-contours", contour_dicom_store=str(tmpdir),
+            num_shards=4, shard_index=shard_index, seed=3, target_size=None)
+        x_batch, _ = next(dset.generate_batch(batch_size=3))
+        shards.append(x_batch[:, 0, 0].tolist())
+    # The 2 samples padding the last shards are the first ones of the first shards
+    assert sorted(sum(shards, [])) == sorted(list(range(10)) + shards[0][:1] + shards[1][:1])
+    assert shards[2][2:] + shards[3][2:] == shards[0][:1] + shards[1][:1]
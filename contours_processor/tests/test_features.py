@@ -0,0 +1,38 @@
+from __future__ import absolute_import, division
+
+import numpy as np
+from contours_processor.features import (add_derived_channels, binary_erosion,
+    register_channel, DERIVED_CHANNELS)
+
+
+def test_binary_erosion():
+    """
+    Testing the erosion against a windowed minimum"""
+    masks = np.random.RandomState(0).uniform(size=(2, 12, 15)) > 0.2
+    padded = np.pad(masks, ((0, 0), (2, 2), (2, 2)), mode="symmetric")
+    expected = np.zeros_like(masks)
+    for row in range(12):
+        for col in range(15):
+            expected[:, row, col] = padded[:, row:row + 5, col:col + 5].all(axis=(1, 2))
+    assert (binary_erosion(masks) == expected).all()
+
+
+def test_derived_channels():
+    """
+    Testing derived channels are computed once and recomputed on a new version"""
+    channel = register_channel("test-doubled", ("dicom",), lambda dicom: dicom * 2)
+    try:
+        datasets, sources = {"dicom": np.ones((4, 4))}, {}
+        add_derived_channels(["test-doubled", "masked-dicom"], datasets, sources)
+        assert (datasets["test-doubled"] == 2).all()
+        assert sources == {"test-doubled": "derived:v1"}
+        assert "masked-dicom" not in datasets  # o-contours input is missing
+
+        datasets["test-doubled"] = np.zeros((4, 4))
+        add_derived_channels(["test-doubled"], datasets, sources)
+        assert (datasets["test-doubled"] == 0).all()
+        channel.version = 2
+        add_derived_channels(["test-doubled"], datasets, sources)
+        assert (datasets["test-doubled"] == 2).all()
+    finally:
+        del DERIVED_CHANNELS["test-doubled"]
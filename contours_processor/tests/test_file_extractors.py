@@ -0,0 +1,163 @@
+from __future__ import absolute_import, division
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import h5py
+import numpy as np
+import numpy.testing as npt
+import pytest
+from PIL import Image, ImageDraw
+from contours_processor.cache import DicomCache
+from contours_processor.utils import load_dataset
+from contours_processor.tests.conftest import NpyDicomExtractor, write_contour, write_dicom
+
+
+def _skip_slice_60(output_dir, contour_path, sources):
+    """save_filepath_extractor without an output for slice 60 (module level to be picklable)"""
+    if "-0060-" in contour_path:
+        return None
+    return os.path.join(output_dir, contour_path.replace("/", "_") + ".h5")
+
+
+def _load_outputs(output_dir):
+    return {filename: load_dataset(os.path.join(output_dir, filename))[0]
+            for filename in sorted(os.listdir(output_dir))}
+
+
+def test_save_datasets_workers(make_extractor, tmpdir):
+    """
+    Testing process pool and executor outputs and summaries match the serial path"""
+    # The i-contour of one slice leaks out of its o-contour and fails validation
+    write_contour(tmpdir.join("contours", "SC-HF-I-2", "i-contours",
+        "IM-0001-0040-icontour-manual.txt"), 2)
+    extractor = make_extractor(on_error_action="skip", save_filepath_extractor=_skip_slice_60)
+    expected_summary = {"saved": 3, "skipped": 2, "failed": 1}
+
+    serial_dir = str(tmpdir.mkdir("serial"))
+    assert extractor.save_datasets(serial_dir) == expected_summary
+    expected = _load_outputs(serial_dir)
+    assert len(expected) == 3
+
+    pool_dir, executor_dir = str(tmpdir.mkdir("pool")), str(tmpdir.mkdir("executor"))
+    assert extractor.save_datasets(pool_dir, workers=2) == expected_summary
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        assert extractor.save_datasets(executor_dir, executor=executor) == expected_summary
+    for output_dir in (pool_dir, executor_dir):
+        outputs = _load_outputs(output_dir)
+        assert sorted(outputs) == sorted(expected)
+        for filename, datasets in outputs.items():
+            assert sorted(datasets) == sorted(expected[filename])
+            for key in datasets:
+                npt.assert_array_equal(datasets[key], expected[filename][key])
+
+
+def test_save_datasets_workers_stop_on_error(make_extractor, tmpdir):
+    """
+    Testing the workers stop writing after the first error with on_error_action="raise\""""
+    for slice_idx in range(100, 140):
+        write_dicom(tmpdir.join("dicoms", "SCD0000101", "{}.dcm".format(slice_idx)), slice_idx)
+        write_contour(tmpdir.join("contours", "SC-HF-I-1", "o-contours",
+            "IM-0001-{:04d}-ocontour-manual.txt".format(slice_idx)), 4)
+    extractor = make_extractor(secondary_contours=[])
+    contour_files = extractor._get_contour_files(False)
+    os.remove(extractor._contour_file_inputs(contour_files[11])["dicom"])
+
+    output_dir = str(tmpdir.mkdir("output"))
+    with pytest.raises(IOError):
+        extractor.save_datasets(output_dir, workers=2)
+    # Only the files before the error and the chunks in flight were written
+    chunksize = len(contour_files) // 8
+    assert len(os.listdir(output_dir)) <= 11 + 2 * chunksize
+
+
+def test_worker_dicom_cache_counters(make_extractor, tmpdir):
+    """
+    Testing the DICOM cache counters of the worker processes are merged back"""
+    extractor = make_extractor(dicom_cache=DicomCache())
+    samples = list(extractor.pipeline_generator(extract_workers=2, extract_processes=2))
+    assert extractor.dicom_cache.stats()["misses"] == len(samples) == 6
+
+    extractor.dicom_cache.clear()
+    extractor.save_datasets(str(tmpdir.mkdir("pool")), workers=2)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        extractor.save_datasets(str(tmpdir.mkdir("executor")), executor=executor)
+    assert extractor.dicom_cache.stats()["misses"] == 12
+
+
+def test_sharded_generators(make_extractor):
+    """
+    Testing each shard only extracts its contour files, all the shards with the same length"""
+    extractor = make_extractor()
+    expected = sorted(sources["o-contours"] for _, sources in extractor.datasets_generator())
+    shards = [[sources["o-contours"] for _, sources in extractor.datasets_generator(
+        shuffle=True, num_shards=4, shard_index=shard_index)] for shard_index in range(4)]
+    assert [len(shard) for shard in shards] == [2, 2, 2, 2]
+    # The 6 files are padded with the first 2 ones
+    assert sorted(sum(shards, [])) == sorted(expected + expected[:2])
+
+    samples = extractor.pipeline_generator(num_shards=4, shard_index=3)
+    assert [sources["o-contours"] for _, sources in samples] == [expected[3], expected[1]]
+
+
+class _RescaledDicomExtractor(NpyDicomExtractor):
+    """Extractor of DICOMs rescaled by (2.0, -5.0), whose headers must not be read again"""
+
+    def _decode_dicom_file(self, filename):
+        return np.load(filename) * 2.0 - 5.0, (2.0, -5.0)
+
+    def _read_dicom_rescale(self, filename):
+        raise AssertionError("DICOM header read again for {}".format(filename))
+
+
+def test_save_datasets_rescale_from_decode(contour_folders, tmpdir):
+    """
+    Testing the stored rescale comes from the decode, also for DICOMs from the cache"""
+    contour_root, dicom_root, folder_map = contour_folders
+    extractor = _RescaledDicomExtractor(contour_root, dicom_root,
+        contour_dicom_folder_map=folder_map, target_size=(32, 32), dicom_cache=DicomCache(),
+        storage_options={"rescale_dtype": "int16"})
+    expected = {sources["dicom"]: datasets["dicom"]
+                for datasets, sources in extractor.datasets_generator()}
+    output_dir = str(tmpdir.mkdir("output"))
+    assert extractor.save_datasets(output_dir)["saved"] == 6
+    assert extractor.dicom_cache.stats()["hits"] == 6
+
+    for filename in os.listdir(output_dir):
+        with h5py.File(os.path.join(output_dir, filename), "r") as f:
+            assert f["dicom"].dtype == np.int16
+        datasets, sources = load_dataset(os.path.join(output_dir, filename))
+        npt.assert_array_equal(datasets["dicom"], expected[sources["dicom"]])
+
+
+def _baseline_contour_mask(filename, target_size):
+    """The original per-line parsing and drawing of a contour file"""
+    coords_lst = []
+    with open(filename, "r") as infile:
+        for line in infile:
+            coords = line.strip().split()
+            coords_lst.append((float(coords[0]), float(coords[1])))
+    img = Image.new(mode="L", size=target_size, color=0)
+    ImageDraw.Draw(img).polygon(xy=coords_lst, outline=0, fill=1)
+    return np.array(img).astype(bool)
+
+
+def test_parse_contour_files_match_baseline(make_extractor, tmpdir):
+    """
+    Testing bulk parsed masks match the original per-line path pixel for pixel"""
+    target_size = (40, 28)
+    rng = np.random.RandomState(0)
+    filenames = []
+    for idx in range(20):
+        center = rng.uniform(0.3, 0.7, 2) * target_size
+        angles = np.sort(rng.uniform(0, 2 * np.pi, rng.randint(3, 30)))
+        radii = rng.uniform(2, 15, len(angles))
+        filename = tmpdir.join("polygons", "{}.txt".format(idx))
+        filename.write("".join("{:.2f} {:.2f}\n".format(center[0] + r * np.cos(angle),
+            center[1] + r * np.sin(angle)) for angle, r in zip(angles, radii)), ensure=True)
+        filenames.append(str(filename))
+
+    masks, is_valid = make_extractor(target_size=target_size)._parse_contour_files(filenames)
+    assert all(is_valid)
+    for filename, mask in zip(filenames, masks):
+        npt.assert_array_equal(mask, _baseline_contour_mask(filename, target_size))
@@ -0,0 +1,31 @@
+from __future__ import absolute_import, division
+
+from contours_processor.index import ContourFileIndex
+
+
+def test_file_index(tmpdir):
+    """
+    Testing index build, lookup, save / load and split by patient"""
+    for contour_folder, dicom_folder in [("SC-1", "SCD1"), ("SC-2", "SCD2")]:
+        for slice_idx in (20, 40):
+            tmpdir.join("dicoms", dicom_folder, "{}.dcm".format(slice_idx)).ensure()
+            for contour_type in ("i", "o"):
+                tmpdir.join("contours", contour_folder, "{}-contours".format(contour_type),
+                    "IM-0001-{:04d}-{}contour-manual.txt".format(slice_idx, contour_type)).ensure()
+        tmpdir.join("contours", contour_folder, "o-contours", "notes.txt").ensure()
+
+    index = ContourFileIndex.build(str(tmpdir.join("contours")), str(tmpdir.join("dicoms")),
+        {"SC-1": "SCD1", "SC-2": "SCD2"})
+    assert len(index) == 4
+    o_contours = index.contour_files("o-contours")
+    assert len(o_contours) == 4
+    assert index.lookup(o_contours[0], "dicom").endswith("20.dcm")
+    assert index.lookup(o_contours[0], "i-contours").endswith("IM-0001-0020-icontour-manual.txt")
+
+    index_filename = str(tmpdir.join("index.json"))
+    index.save(index_filename)
+    assert ContourFileIndex.load(index_filename).entries == index.entries
+
+    first, second = index.split(0.5, seed=0)
+    assert len(first) == len(second) == 2
+    assert set(key[0] for key in first.entries).isdisjoint(key[0] for key in second.entries)
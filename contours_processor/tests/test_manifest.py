@@ -0,0 +1,71 @@
+from __future__ import absolute_import, division
+
+import os
+
+from contours_processor.manifest import MANIFEST_FILENAME
+
+
+def _save(extractor, output_dir, manifest_check="mtime"):
+    return extractor.save_datasets(output_dir, incremental=True, manifest_check=manifest_check)
+
+
+def _outputs_mtime(output_dir):
+    return {filename: os.stat(os.path.join(output_dir, filename)).st_mtime_ns
+            for filename in os.listdir(output_dir) if filename.endswith(".h5")}
+
+
+def _bump_mtime(filename):
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_incremental_unchanged_and_changed_inputs(make_extractor, tmpdir):
+    """
+    Testing unchanged outputs are skipped and a changed input rebuilds only its output"""
+    output_dir = str(tmpdir.mkdir("output"))
+    extractor = make_extractor()
+    assert _save(extractor, output_dir) == {"saved": 6, "skipped": 0, "failed": 0, "unchanged": 0}
+    assert os.path.isfile(os.path.join(output_dir, MANIFEST_FILENAME))
+    assert _save(extractor, output_dir) == {"saved": 0, "skipped": 0, "failed": 0, "unchanged": 6}
+
+    mtimes = _outputs_mtime(output_dir)
+    _bump_mtime("dicoms/SCD0000101/40.dcm")
+    assert _save(extractor, output_dir)["saved"] == 1
+    changed = [name for name, mtime in _outputs_mtime(output_dir).items() if mtime != mtimes[name]]
+    assert changed == ["SC-HF-I-1-IM-0001-0040-dicom-contours.h5"]
+
+    # With hashes, only a change of content rebuilds the output
+    assert _save(extractor, output_dir, "hash")["saved"] == 6
+    _bump_mtime("contours/SC-HF-I-2/i-contours/IM-0001-0020-icontour-manual.txt")
+    assert _save(extractor, output_dir, "hash")["unchanged"] == 6
+    with open("contours/SC-HF-I-2/i-contours/IM-0001-0020-icontour-manual.txt", "a") as f:
+        f.write("12.00 12.00\n")
+    assert _save(extractor, output_dir, "hash") == {"saved": 1, "skipped": 0, "failed": 0,
+                                                    "unchanged": 5}
+
+
+def test_incremental_settings_change(make_extractor, tmpdir):
+    """
+    Testing target_size and storage_options changes rebuild every output"""
+    output_dir = str(tmpdir.mkdir("output"))
+    assert _save(make_extractor(), output_dir)["saved"] == 6
+    assert _save(make_extractor(target_size=(30, 30)), output_dir)["saved"] == 6
+    assert _save(make_extractor(target_size=(30, 30)), output_dir)["unchanged"] == 6
+    extractor = make_extractor(target_size=(30, 30), storage_options={"compression": "gzip"})
+    assert _save(extractor, output_dir)["saved"] == 6
+
+
+def test_incremental_missing_output_and_corrupt_manifest(make_extractor, tmpdir):
+    """
+    Testing deleted outputs and a corrupt manifest are rebuilt"""
+    output_dir = str(tmpdir.mkdir("output"))
+    extractor = make_extractor()
+    _save(extractor, output_dir)
+
+    os.remove(os.path.join(output_dir, "SC-HF-I-2-IM-0001-0060-dicom-contours.h5"))
+    assert _save(extractor, output_dir) == {"saved": 1, "skipped": 0, "failed": 0, "unchanged": 5}
+
+    with open(os.path.join(output_dir, MANIFEST_FILENAME), "w") as f:
+        f.write('{"settings": {"target_size": [32,')
+    assert _save(extractor, output_dir)["saved"] == 6
+    assert _save(extractor, output_dir)["unchanged"] == 6
@@ -0,0 +1,54 @@
+from __future__ import absolute_import, division
+
+import time
+
+import numpy.testing as npt
+import pytest
+from contours_processor.pipeline import Pipeline
+from contours_processor.stats import PipelineStats
+from contours_processor.exceptions import InvalidDatasetError
+
+
+def test_pipeline():
+    """
+    Testing ordered results, dropped items and errors across stages"""
+    def drop_fifths(item):
+        time.sleep(0.001 * (item % 3))
+        if item % 5:
+            return item
+
+    pipeline = Pipeline(range(50), queue_size=2)
+    pipeline.add_stage(drop_fifths, workers=4).add_stage(lambda item: item * 2, workers=2)
+    assert list(pipeline) == [item * 2 for item in range(50) if item % 5]
+
+    def fail_on_seven(item):
+        if item == 7:
+            raise InvalidDatasetError("Invalid item {}".format(item))
+        return item
+
+    pipeline = Pipeline(range(50)).add_stage(fail_on_seven, workers=3)
+    with pytest.raises(InvalidDatasetError):
+        list(pipeline)
+
+
+def test_pipeline_generator(make_extractor):
+    """
+    Testing pipelined extraction matches the serial generator, in threads or processes"""
+    extractor = make_extractor(stats=PipelineStats())
+    expected = [sources for _, sources in extractor.datasets_generator()]
+    samples = list(extractor.pipeline_generator(extract_workers=3, queue_size=2))
+    assert [sources for _, sources in samples] == expected
+
+    extractor.stats.reset()
+    samples = list(extractor.pipeline_generator(extract_workers=2, extract_processes=2))
+    # Stats recorded in the worker processes are merged back
+    assert extractor.stats.snapshot()["counters"]["files_processed"] == len(expected)
+    assert [sources for _, sources in samples] == expected
+    npt.assert_array_equal(samples[0][0]["dicom"], next(extractor.datasets_generator())[0]["dicom"])
+
+    # Invalid samples are dropped when errors are only logged
+    with open(expected[1]["i-contours"], "w") as f:
+        f.write("0 0\n31 0\n31 31\n0 31\n")
+    extractor = make_extractor(on_error_action="skip")
+    samples = list(extractor.pipeline_generator(extract_workers=3))
+    assert [sources for _, sources in samples] == expected[:1] + expected[2:]
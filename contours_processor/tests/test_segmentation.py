@@ -0,0 +1,52 @@
+from __future__ import absolute_import, division
+
+import numpy as np
+import numpy.testing as npt
+from contours_processor.segmentation import (otsu_thresholds, iou_scores, dice_scores,
+    CohortStats)
+
+
+def _otsu(image, bins=256):
+    """Per image Otsu threshold, as skimage.filters.threshold_otsu"""
+    hist, edges = np.histogram(image.ravel(), bins, range=(image.min(), image.max()))
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight1 = np.cumsum(hist)
+    weight2 = np.cumsum(hist[::-1])[::-1]
+    mean1 = np.cumsum(hist * centers) / weight1
+    mean2 = (np.cumsum((hist * centers)[::-1]) / weight2[::-1])[::-1]
+    variance = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return centers[np.argmax(variance)]
+
+
+def test_otsu_thresholds():
+    """
+    Testing batched Otsu thresholds against the per image computation"""
+    rng = np.random.RandomState(0)
+    images = np.concatenate([rng.normal(50, 10, (6, 16, 16)), rng.normal(150, 20, (6, 16, 16))], axis=2)
+    masks = rng.uniform(size=images.shape) > 0.3
+    npt.assert_allclose(otsu_thresholds(images), [_otsu(image) for image in images])
+    npt.assert_allclose(otsu_thresholds(images, masks),
+        [_otsu(image[mask]) for image, mask in zip(images, masks)])
+    npt.assert_allclose(otsu_thresholds(np.full((2, 4, 4), 7.0)), [7.0, 7.0])
+
+
+def test_scores_and_cohort_stats():
+    """
+    Testing IoU / Dice and the streaming cohort statistics"""
+    predicted = np.zeros((2, 4, 4), dtype=bool)
+    target = np.zeros((2, 4, 4), dtype=bool)
+    predicted[0, :2] = True
+    target[0, 1:3] = True
+    npt.assert_allclose(iou_scores(predicted, target), [1 / 3, 1.0])
+    npt.assert_allclose(dice_scores(predicted, target), [0.5, 1.0])
+
+    values = np.random.RandomState(0).uniform(size=100)
+    cohort_stats, other = CohortStats(), CohortStats()
+    for chunk in np.array_split(values[:60], 4):
+        cohort_stats.update({"iou": chunk})
+    other.update({"iou": values[60:]})
+    cohort_stats.merge(other)
+    summary = cohort_stats.summary()["iou"]
+    assert summary["count"] == 100
+    npt.assert_allclose([summary["mean"], summary["std"], summary["max"]],
+        [values.mean(), values.std(), values.max()])
@@ -0,0 +1,33 @@
+from __future__ import absolute_import, division
+
+from contours_processor.stats import PipelineStats, NullStats, TIMING_BUCKETS
+
+
+def test_pipeline_stats():
+    """
+    Testing timings, counters, callback and merging worker snapshots"""
+    events = []
+    stats = PipelineStats(callback=lambda kind, name, value: events.append((kind, name)))
+    with stats.timer("dicom_decode"):
+        pass
+    stats.observe("dicom_decode", 0.5)
+    stats.incr("files_processed")
+    stats.incr("bytes_written", 100)
+    assert events == [("timing", "dicom_decode"), ("timing", "dicom_decode"),
+        ("counter", "files_processed"), ("counter", "bytes_written")]
+
+    worker_stats = PipelineStats()
+    worker_stats.observe("dicom_decode", 2.0)
+    worker_stats.incr("files_processed")
+    stats.merge(worker_stats.snapshot())
+
+    snapshot = stats.snapshot()
+    assert snapshot["counters"] == {"files_processed": 2, "bytes_written": 100}
+    timing = snapshot["timings"]["dicom_decode"]
+    assert timing["count"] == 3 and timing["max"] == 2.0
+    assert sum(timing["buckets"]) == 3 and len(timing["buckets"]) == len(TIMING_BUCKETS) + 1
+
+    null_stats = NullStats()
+    with null_stats.timer("dicom_decode"):
+        null_stats.incr("files_processed")
+    assert null_stats.snapshot()["counters"] == {}
@@ -0,0 +1,79 @@
+from __future__ import absolute_import, division
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+from contours_processor.exceptions import InvalidDatasetError
+from contours_processor.stores import (PackedDatasetWriter, PackedDatasetReader,
+    NpyDatasetWriter, NpyDatasetReader, NPY_INDEX_FILENAME, open_store)
+
+
+def test_packed_roundtrip(tmpdir):
+    """
+    Testing packed datasets are read back in the requested order across shards"""
+    samples = []
+    with PackedDatasetWriter(str(tmpdir), shard_size=3) as writer:
+        for idx in range(7):
+            datasets = {"dicom": np.full((4, 5), idx, dtype=np.int16),
+                        "o-contours": np.eye(4, 5, dtype=bool)}
+            if idx % 2 == 0:
+                datasets["i-contours"] = np.zeros((4, 5), dtype=bool)
+            writer.append(datasets, {"dicom": "{}.dcm".format(idx)})
+            samples.append(datasets)
+    assert len(writer.filenames) == 3
+
+    reader = PackedDatasetReader(str(tmpdir.join("*.h5")))
+    assert len(reader) == 7
+    indices = [6, 0, 4, 4, 1]
+    datasets, present = reader.read(indices, ["dicom", "i-contours"])
+    npt.assert_array_equal(datasets["dicom"][:, 0, 0], indices)
+    npt.assert_array_equal(present["i-contours"], [True, True, True, True, False])
+    assert [source["dicom"] for source in reader.sources(indices)] == ["6.dcm", "0.dcm", "4.dcm", "4.dcm", "1.dcm"]
+    reader.close()
+
+
+def test_npy_roundtrip(tmpdir):
+    """
+    Testing .npy store is memory mapped and contiguous reads are views"""
+    with NpyDatasetWriter(str(tmpdir)) as writer:
+        for idx in range(5):
+            datasets = {"dicom": np.full((4, 5), idx, dtype=np.float32)}
+            if idx > 1:
+                datasets["o-contours"] = np.ones((4, 5), dtype=bool)
+            writer.append(datasets, {"dicom": "{}.dcm".format(idx)})
+
+    reader = open_store(str(tmpdir))
+    assert isinstance(reader, NpyDatasetReader)
+    assert len(reader) == 5
+    datasets, present = reader.read([1, 2, 3])
+    assert isinstance(datasets["dicom"].base, np.memmap)
+    npt.assert_array_equal(datasets["dicom"][:, 0, 0], [1, 2, 3])
+    npt.assert_array_equal(present["o-contours"], [False, True, True])
+    datasets, present = reader.read([4, 0])
+    npt.assert_array_equal(datasets["dicom"][:, 0, 0], [4, 0])
+    assert reader.sources([4])[0]["dicom"] == "4.dcm"
+
+
+def test_writers_reject_lossy_dtypes(tmpdir):
+    """
+    Testing samples are never silently cast to the dtype of the first sample"""
+    for writer in (PackedDatasetWriter(str(tmpdir.mkdir("packed"))),
+                   NpyDatasetWriter(str(tmpdir.mkdir("npy")))):
+        with writer:
+            writer.append({"dicom": np.zeros((4, 5), dtype=np.int16)})
+            # Safe casts are stored, lossy ones raise
+            writer.append({"dicom": np.ones((4, 5), dtype=np.uint8)})
+            with pytest.raises(InvalidDatasetError):
+                writer.append({"dicom": np.full((4, 5), 70000.0)})
+
+
+def test_npy_writer_error_leaves_no_index(tmpdir):
+    """
+    Testing an export stopped by an error isn't readable as a complete store"""
+    with pytest.raises(ValueError):
+        with NpyDatasetWriter(str(tmpdir)) as writer:
+            writer.append({"dicom": np.zeros((4, 5), dtype=np.int16)})
+            raise ValueError("export failed")
+    assert not tmpdir.join(NPY_INDEX_FILENAME).check()
+    with pytest.raises(InvalidDatasetError):
+        open_store(str(tmpdir))
@@ -0,0 +1,41 @@
+from __future__ import absolute_import, division
+
+import numpy as np
+from contours_processor.transforms import BatchTransform, resize_batch
+
+
+def test_batch_transform():
+    """
+    Testing center / random crops, padding and nearest neighbour resizing"""
+    batch = np.arange(2 * 3 * 6 * 8).reshape(2, 3, 6, 8)
+    assert (BatchTransform((4, 4))(batch) == batch[..., 1:5, 2:6]).all()
+
+    cropped = BatchTransform((4, 4), crop_mode="random")(batch, np.array([[0, 0], [0.99, 0.99]]))
+    assert (cropped[0] == batch[0, :, :4, :4]).all()
+    assert (cropped[1] == batch[1, :, 2:, 4:]).all()
+
+    padded = BatchTransform((10, 10))(batch)
+    assert padded.shape == (2, 3, 10, 10)
+    assert (padded[..., 2:8, 1:9] == batch).all()
+    assert (BatchTransform((8, 6), padding=1)(batch) == batch).all()
+
+    mask = np.zeros((1, 4, 4), dtype=bool)
+    mask[0, :2, :2] = True
+    resized = resize_batch(mask, (8, 8))
+    assert resized.dtype == bool
+    assert resized.sum() == 16 and resized[0, :4, :4].all()
+
+
+def test_crop_into():
+    """
+    Testing in place crops match the batch transform, for any shape, padding and offset"""
+    rng = np.random.RandomState(0)
+    for trial in range(200):
+        height, width, target_height, target_width = rng.randint(1, 12, 4)
+        transform = BatchTransform((target_width, target_height), padding=rng.randint(0, 4),
+            crop_mode=("center", "random")[trial % 2])
+        data = rng.randint(1, 100, (2, height, width))
+        offsets = transform.crop_offsets(1, rng)
+        out = np.full(transform.output_shape(data.shape), -1)
+        transform.crop_into(out, data, offsets[0])
+        assert (out == transform(data[None], offsets)[0]).all()
@@ -0,0 +1,104 @@
+from __future__ import absolute_import, division
+
+import h5py
+import numpy as np
+import numpy.testing as npt
+from contours_processor.utils import dump_dataset, load_dataset, parse_contour_coords
+
+
+def test_dump_dataset_codecs(tmpdir):
+    """
+    Testing compressed, bit-packed and rescaled datasets round trip"""
+    rng = np.random.RandomState(0)
+    mask = rng.uniform(size=(20, 13)) > 0.5
+    dicom = rng.randint(0, 1000, size=(20, 13)) * 2.0 - 5.0
+    datasets = {"dicom": dicom, "o-contours": mask}
+
+    for mask_encoding in (None, "uint8", "packbits"):
+        filename = str(tmpdir.join("{}.h5".format(mask_encoding)))
+        dump_dataset(filename, datasets, {"dicom": "1.dcm"}, compression="gzip",
+            mask_encoding=mask_encoding, rescale={"dicom": (2.0, -5.0)})
+        loaded, sources = load_dataset(filename)
+        assert loaded["o-contours"].dtype == bool
+        assert (loaded["o-contours"] == mask).all()
+        assert (loaded["dicom"] == dicom).all()
+        with h5py.File(filename, "r") as f:
+            assert f["dicom"].dtype == np.int16
+            assert f["dicom"].compression == "gzip"
+
+    # Lossy rescales keep the original dtype
+    filename = str(tmpdir.join("lossy.h5"))
+    dump_dataset(filename, datasets, rescale={"dicom": (3.0, 0.0)})
+    with h5py.File(filename, "r") as f:
+        assert f["dicom"].dtype == np.float64
+
+
+def test_load_dataset_channels(tmpdir):
+    """
+    Testing that only the selected channels are read"""
+    filename = str(tmpdir.join("sample.h5"))
+    mask = np.ones((4, 4), dtype=bool)
+    dump_dataset(filename, {"dicom": np.zeros((4, 4)), "o-contours": mask})
+
+    datasets, _ = load_dataset(filename, channels=["dicom", "i-contours"])
+    assert list(datasets) == ["dicom"]
+    datasets, _ = load_dataset(filename, channels=["dicom", "i-contours"], require_all=True)
+    assert datasets == {}
+    datasets, _ = load_dataset(filename, channels=["o-contours"], require_all=True)
+    assert list(datasets) == ["o-contours"]
+
+
+def test_dump_dataset_identity_rescale(tmpdir):
+    """
+    Testing that identity rescales keep the stored and loaded dtype"""
+    filename = str(tmpdir.join("identity.h5"))
+    dicom = np.arange(16, dtype=np.int16).reshape(4, 4)
+    dump_dataset(filename, {"dicom": dicom}, rescale={"dicom": (1.0, 0.0)})
+    with h5py.File(filename, "r") as f:
+        assert "slope" not in f["dicom"].attrs
+    loaded, _ = load_dataset(filename)
+    assert loaded["dicom"].dtype == np.int16
+    assert (loaded["dicom"] == dicom).all()
+
+
+def test_selected_channels_only_are_decoded(tmpdir, monkeypatch):
+    """
+    Testing load_dataset and ContourDataset never decode the other channels"""
+    from contours_processor import ContourDataset, utils
+
+    decoded = []
+    decode_dataset = utils._decode_dataset
+
+    def recording_decode(h5_dataset, rescale=True):
+        decoded.append(h5_dataset.name.lstrip("/"))
+        return decode_dataset(h5_dataset, rescale)
+    monkeypatch.setattr(utils, "_decode_dataset", recording_decode)
+
+    mask = np.ones((4, 4), dtype=bool)
+    for idx in range(3):
+        dump_dataset(str(tmpdir.join("{}.h5".format(idx))), {"dicom": np.zeros((4, 4)),
+            "o-contours": mask, "i-contours": mask, "dicom-sobel": np.zeros((4, 4))})
+
+    load_dataset(str(tmpdir.join("0.h5")), channels=["o-contours"])
+    assert decoded == ["o-contours"]
+
+    del decoded[:]
+    dset = ContourDataset("dicom", "i-contours", contour_dicom_folder=str(tmpdir), target_size=None)
+    x_batch, y_batch = next(dset.generate_batch(batch_size=3, shuffle=False))
+    assert x_batch.shape == y_batch.shape == (3, 4, 4)
+    assert sorted(set(decoded)) == ["dicom", "i-contours"]
+
+
+def test_parse_contour_coords():
+    """
+    Testing contour text is parsed into (n, 2) coordinates"""
+    coords = parse_contour_coords("120.50 137.50\n121.50 137.50\n\n122.00 138.25\n")
+    npt.assert_array_equal(coords, [[120.5, 137.5], [121.5, 137.5], [122.0, 138.25]])
+
+
+def test_parse_contour_coords_extra_columns():
+    """
+    Testing only the first two columns are kept, whatever the number of lines"""
+    npt.assert_array_equal(parse_contour_coords("10 20 99\n30 40 99"), [[10, 20], [30, 40]])
+    npt.assert_array_equal(parse_contour_coords("10 20 99\n30 40 99\n50 60 99\n"),
+        [[10, 20], [30, 40], [50, 60]])
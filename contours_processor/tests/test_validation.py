@@ -0,0 +1,40 @@
+from __future__ import absolute_import, division
+
+import numpy as np
+from contours_processor.utils import dump_dataset
+from contours_processor.validation import validate_dataset
+
+
+def test_validate_dataset(tmpdir):
+    """
+    Testing the bulk validation report of a processed folder"""
+    o_contours = np.zeros((16, 16), dtype=bool)
+    o_contours[4:12, 4:12] = True
+    i_contours = np.zeros((16, 16), dtype=bool)
+    i_contours[6:10, 6:10] = True
+    leaking = i_contours.copy()
+    leaking[0, :3] = True
+    dicom = np.ones((16, 16))
+
+    samples = {
+        "a-valid": {"dicom": dicom, "o-contours": o_contours, "i-contours": i_contours},
+        "b-leaking": {"dicom": dicom, "o-contours": o_contours, "i-contours": leaking},
+        "c-empty": {"dicom": dicom, "o-contours": np.zeros((16, 16), dtype=bool)},
+        "d-shapes": {"dicom": np.ones((8, 16)), "o-contours": o_contours},
+    }
+    for name, datasets in samples.items():
+        dump_dataset(str(tmpdir.join("{}.h5".format(name))), datasets)
+    tmpdir.join("c-corrupt.h5").write("not an HDF5 file")
+
+    report_filename = str(tmpdir.join("report.csv"))
+    records = validate_dataset(str(tmpdir), report_filename, chunk_size=3)
+    # Records follow the filenames order, files failing to load included
+    assert [record["filename"] for record in records] == sorted(
+        str(tmpdir.join("{}.h5".format(name))) for name in list(samples) + ["c-corrupt"])
+    assert [record["valid"] for record in records] == [True, False, False, False, False]
+    assert records[1]["subset_violations"] == 3
+    assert records[2]["error"].startswith("Error Processing File")
+    assert records[3]["empty_masks"] == "o-contours"
+    assert not records[4]["shapes_match"]
+    assert len(tmpdir.join("report.csv").readlines()) == 6
+    assert validate_dataset(str(tmpdir), chunk_size=2, workers=2) == records
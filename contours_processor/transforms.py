@@ -0,0 +1,159 @@
+import numpy as np
+
+CROP_MODES = ("center", "random", "resize")
+
+
+def _spatial_index(batch, index):
+    """Reshape (n, size) per-sample index for take_along_axis over the last axes of batch"""
+    return index.reshape((index.shape[0],) + (1,) * (batch.ndim - 3) + index.shape[1:])
+
+
+def pad_batch(batch, padding):
+    """Zero pad the last two (height, width) axes of batch by padding pixels on each side"""
+    if not padding:
+        return batch
+    pad_width = [(0, 0)] * (batch.ndim - 2) + [(padding, padding)] * 2
+    return np.pad(batch, pad_width, mode="constant")
+
+
+def crop_batch(batch, size, offsets):
+    """Crop the last two axes of batch to size (height, width) at per-sample offsets
+
+    :param offsets: (n, 2) array of the top, left offset of each sample
+    """
+    height, width = size
+    offsets = np.asarray(offsets)
+    if (offsets == offsets[0]).all():
+        top, left = offsets[0]
+        return batch[..., top:top + height, left:left + width]
+    rows = offsets[:, :1] + np.arange(height)
+    cols = offsets[:, 1:] + np.arange(width)
+    batch = np.take_along_axis(batch, _spatial_index(batch, rows[:, :, None]), axis=-2)
+    return np.take_along_axis(batch, _spatial_index(batch, cols[:, None, :]), axis=-1)
+
+
+def pad_to_size(batch, size):
+    """Zero pad (centered) the last two axes of batch up to at least size (height, width)"""
+    pad_width = [(0, 0)] * (batch.ndim - 2)
+    for axis_size, target in zip(batch.shape[-2:], size):
+        excess = max(target - axis_size, 0)
+        pad_width.append((excess // 2, excess - excess // 2))
+    if not any(before or after for before, after in pad_width):
+        return batch
+    return np.pad(batch, pad_width, mode="constant")
+
+
+def _source_coords(src_size, dst_size):
+    """Return the pixel center source coordinates of dst_size samples over src_size"""
+    return (np.arange(dst_size) + 0.5) * (src_size / dst_size) - 0.5
+
+
+def resize_batch(batch, size, nearest=True):
+    """Resize the last two axes of batch to size (height, width)
+
+    :param nearest: Nearest neighbour sampling (for masks) when True, otherwise
+        bilinear interpolation returning float32
+    """
+    height, width = size
+    src_height, src_width = batch.shape[-2:]
+    if (src_height, src_width) == (height, width):
+        return batch
+    ys = _source_coords(src_height, height)
+    xs = _source_coords(src_width, width)
+    if nearest:
+        rows = np.clip(np.floor(ys + 0.5).astype(int), 0, src_height - 1)
+        cols = np.clip(np.floor(xs + 0.5).astype(int), 0, src_width - 1)
+        return np.take(np.take(batch, rows, axis=-2), cols, axis=-1)
+
+    ys = np.clip(ys, 0, src_height - 1)
+    xs = np.clip(xs, 0, src_width - 1)
+    y0 = np.floor(ys).astype(int)
+    x0 = np.floor(xs).astype(int)
+    y1 = np.minimum(y0 + 1, src_height - 1)
+    x1 = np.minimum(x0 + 1, src_width - 1)
+    wy = (ys - y0).astype(np.float32)[:, None]
+    wx = (xs - x0).astype(np.float32)
+
+    batch = batch.astype(np.float32, copy=False)
+    top = np.take(batch, y0, axis=-2)
+    bottom = np.take(batch, y1, axis=-2)
+    rows = top + (bottom - top) * wy
+    left = np.take(rows, x0, axis=-1)
+    right = np.take(rows, x1, axis=-1)
+    return left + (right - left) * wx
+
+
+class BatchTransform(object):
+    """Pad, crop or resize whole batches to a target size.
+
+    The batch is first zero padded by padding pixels on each side.  With the
+    "center" and "random" crop modes, samples larger than the target are cropped
+    and smaller ones zero padded; "resize" rescales the samples instead.  Only
+    the last two (height, width) axes are transformed, so image and mask batches
+    of the same samples stay aligned when transformed with the same offsets.
+    """
+
+    def __init__(self, target_size, padding=0, crop_mode="center"):
+        """
+        :param target_size: (width, height) of the transformed samples, as the
+            target_size of ContourFileExtractor
+        """
+        if crop_mode not in CROP_MODES:
+            raise ValueError("Unknown crop mode: {}".format(crop_mode))
+        width, height = target_size
+        self.size = (height, width)
+        self.padding = padding
+        self.crop_mode = crop_mode
+
+    def output_shape(self, sample_shape):
+        """Return the shape of a transformed sample of sample_shape"""
+        return tuple(sample_shape[:-2]) + self.size
+
+    def crop_offsets(self, n_samples, rng=np.random):
+        """Return (n, 2) relative crop offsets in [0, 1), shared by the batches of the same samples"""
+        if self.crop_mode == "random":
+            return rng.random_sample((n_samples, 2))
+        return np.full((n_samples, 2), 0.5)
+
+    def _crop_window(self, size, target, offset):
+        """Return the (source, destination) slices of one axis of a padded and cropped sample"""
+        padded = size + 2 * self.padding
+        crop = min(padded, target)
+        top = int(np.floor(offset * (max(padded - target, 0) + 1))) - self.padding
+        start, stop = max(top, 0), max(min(top + crop, size), 0)
+        dst_start = (target - crop) // 2 + start - top
+        return slice(start, max(stop, start)), slice(dst_start, dst_start + max(stop - start, 0))
+
+    def crop_into(self, out, data, offset):
+        """Write the transformed data of one sample into out, in place
+
+        Same as self(data[None], offset[None])[0], without the padded and cropped
+        copies.  Not available with the "resize" crop mode.
+
+        :param out: Array of shape output_shape(data.shape), ex: a sample of a batch buffer
+        :param offset: Relative (top, left) crop offset of the sample from crop_offsets
+        """
+        if self.crop_mode == "resize":
+            raise ValueError("Resized samples can't be cropped in place")
+        (src_rows, dst_rows), (src_cols, dst_cols) = [self._crop_window(size, target, rel)
+            for size, target, rel in zip(data.shape[-2:], self.size, offset)]
+        if (dst_rows.stop - dst_rows.start, dst_cols.stop - dst_cols.start) != self.size:
+            out[...] = 0
+        out[..., dst_rows, dst_cols] = data[..., src_rows, src_cols]
+
+    def __call__(self, batch, offsets=None, nearest=True):
+        """Return the transformed batch
+
+        :param offsets: Relative crop offsets from crop_offsets.  Default to center crops
+        :param nearest: Nearest neighbour resizing when True (masks), bilinear otherwise
+        """
+        batch = pad_batch(batch, self.padding)
+        if self.crop_mode == "resize":
+            return resize_batch(batch, self.size, nearest)
+
+        excess = np.maximum(np.array(batch.shape[-2:]) - self.size, 0)
+        if offsets is None:
+            offsets = self.crop_offsets(len(batch))
+        offsets = np.floor(offsets * (excess + 1)).astype(int)
+        batch = crop_batch(batch, np.minimum(batch.shape[-2:], self.size), offsets)
+        return pad_to_size(batch, self.size)
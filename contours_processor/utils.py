@@ -1,27 +1,74 @@
 import numpy as np
-import h5py
 
 from .exceptions import InvalidDatasetError
 
 
-def dump_dataset(filename, datasets, sources=None):
+MASK_ENCODINGS = (None, "uint8", "packbits")
+
+
+def _encode_rescaled(data, slope, intercept, dtype):
+    """Return data as dtype pixels such that pixels * slope + intercept == data, None if lossy"""
+    dtype = np.dtype(dtype)
+    pixels = np.rint((data - intercept) / slope)
+    info = np.iinfo(dtype)
+    if pixels.size and (pixels.min() < info.min or pixels.max() > info.max):
+        return None
+    pixels = pixels.astype(dtype)
+    if not np.array_equal(pixels * slope + intercept, data):
+        return None
+    return pixels
+
+
+def dump_dataset(filename, datasets, sources=None, compression=None, compression_opts=None,
+        mask_encoding=None, rescale=None, rescale_dtype="int16"):
     """Save the Datasets and Sources in file
 
     Create HDF5 formatted datasets and metadata keys to process data.
+
+    :param compression: HDF5 compression filter of the (chunked) datasets: "gzip",
+        "lzf" or None.  compression_opts is the gzip level
+    :param mask_encoding: Store the boolean masks as "uint8" or bit-packed along the
+        rows with np.packbits ("packbits").  Default to None (stored as bool)
+    :param rescale: Dictionary of dataset key -> (slope, intercept).  Those datasets
+        are stored as rescale_dtype pixels with the slope and intercept attributes
+        when that is lossless, load_dataset applies the rescale.  Identity rescales,
+        (1.0, 0.0), are ignored
     """
     if datasets is None:
         datasets = {}
     if sources is None:
         sources = {}
+    if rescale is None:
+        rescale = {}
+    if mask_encoding not in MASK_ENCODINGS:
+        raise ValueError("Unknown mask encoding: {}".format(mask_encoding))
+
+    import h5py
 
     try:
         with h5py.File(filename, "w") as f:
             data_keys = []
             for key, dataset in datasets.items():
-                f.create_dataset(key,
+                attrs = {}
+                if dataset.dtype == bool and mask_encoding == "packbits":
+                    attrs = {"encoding": "packbits", "width": dataset.shape[-1]}
+                    dataset = np.packbits(dataset, axis=-1)
+                elif dataset.dtype == bool and mask_encoding == "uint8":
+                    attrs = {"encoding": "uint8"}
+                    dataset = dataset.view(np.uint8)
+                elif key in rescale and tuple(rescale[key]) != (1.0, 0.0):
+                    slope, intercept = rescale[key]
+                    pixels = _encode_rescaled(dataset, slope, intercept, rescale_dtype)
+                    if pixels is not None:
+                        attrs = {"slope": slope, "intercept": intercept}
+                        dataset = pixels
+                h5_dataset = f.create_dataset(key,
                                  dataset.shape,
                                  dtype=dataset.dtype,
-                                data=dataset)
+                                 data=dataset,
+                                 compression=compression,
+                                 compression_opts=compression_opts)
+                h5_dataset.attrs.update(attrs)
                 data_keys.append(key)
             metadata = f.create_group("metadata")
             metadata["_data_keys"] = ",".join(data_keys)
@@ -32,28 +79,77 @@ def dump_dataset(filename, datasets, sources=None):
         raise InvalidDatasetError("Error Saving Datasets File: {}".format(filename))
 
 
-def load_dataset(filename):
+def _decode_dataset(h5_dataset, rescale=True):
+    """Return the numpy array of an HDF5 dataset written by dump_dataset"""
+    data = h5_dataset[()]
+    attrs = h5_dataset.attrs
+    encoding = attrs.get("encoding")
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode("utf-8")
+    if encoding == "packbits":
+        return np.unpackbits(data, axis=-1)[..., :attrs["width"]].view(bool)
+    if encoding == "uint8":
+        return data.view(bool)
+    if rescale and "slope" in attrs:
+        return data * attrs["slope"] + attrs["intercept"]
+    return data
+
+
+def _read_str(h5_dataset):
+    """Return the string stored in a scalar HDF5 dataset (h5py 3 reads them as bytes)"""
+    value = h5_dataset[()]
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return value
+
+
+def load_dataset(filename, rescale=True, channels=None, require_all=False):
     """Return datasets and sources in the file
 
-    Use the metadata keys to create dataset arrays.  Convert HDF5 to numpy arrays
+    Use the metadata keys to create dataset arrays.  Convert HDF5 to numpy arrays,
+    decoding the masks and applying the slope / intercept of the rescaled datasets
+    (unless rescale is False) saved by dump_dataset
+
+    :param channels: List of the channels to read.  Default to None (all channels)
+    :param require_all: When True and some of the channels aren't in the file
+        metadata, return no datasets without reading any pixel data
     """
+    import h5py
     try:
         datasets = {}
         sources = {}
         with h5py.File(filename, "r") as f:
             metadata = f.get("metadata")
-            data_keys = metadata["_data_keys"].value
-            data_keys = data_keys.split(",")
+            data_keys = _read_str(metadata["_data_keys"]).split(",")
+            if channels is not None:
+                if require_all and not set(channels).issubset(data_keys):
+                    data_keys = []
+                data_keys = [data_key for data_key in data_keys if data_key in channels]
             for data_key in data_keys:
-                datasets[data_key] = f.get(data_key).value
+                datasets[data_key] = _decode_dataset(f.get(data_key), rescale)
             for key, g_item in metadata.get("sources").items():
-                sources[key] = g_item.value
+                sources[key] = _read_str(g_item)
             sources["filename"] = filename
     except Exception:
         raise InvalidDatasetError("Error Processing File: {}".format(filename))
     return datasets, sources
 
 
+def parse_contour_coords(text):
+    """Return (n, 2) array of the x, y coordinates in a contour file's text
+
+    The whole text is converted in one NumPy call instead of one float() per value.
+    """
+    values = np.array(text.split(), dtype=np.float64)
+    lines = text.split("\n")
+    n_lines = len(lines) - lines.count("")
+    if values.size != 2 * n_lines:
+        # Lines with extra columns, only keep the first two values of each line
+        rows = [line.split() for line in lines if line.strip()]
+        values = np.array([row[:2] for row in rows], dtype=np.float64)
+    return values.reshape(-1, 2)
+
+
 def is_subset_binary(main_array, subset_array):
     """Return True if subset_array is fully contained in the main_array.
 
@@ -61,5 +157,17 @@ def is_subset_binary(main_array, subset_array):
     Usage: to check if i-contours is within the boundaries of o-contours
     """
     assert main_array.shape == subset_array.shape
-    incorrect_indxes = np.where((main_array == 0) & (subset_array > 0))[0]
-    return len(incorrect_indxes) == 0
+    return not np.any((main_array == 0) & (subset_array > 0))
+
+
+def _padded_shard(items, num_shards, shard_index):
+    """Return every num_shards-th item of items starting at shard_index, as an array
+
+    items is first padded by wrapping around to a multiple of num_shards, so every
+    shard has the same length (data parallel workers must run the same number of steps).
+    """
+    items = np.asarray(items)
+    if num_shards == 1 or not len(items):
+        return items
+    n_padded = -(-len(items) // num_shards) * num_shards
+    return np.resize(items, n_padded)[shard_index::num_shards]
@@ -0,0 +1,169 @@
+import os
+import csv
+from glob import glob
+import numpy as np
+
+from .utils import load_dataset
+from .exceptions import InvalidDatasetError
+from .stores import open_store, NPY_INDEX_FILENAME
+
+# (inner, outer) mask pairs where the inner mask must be contained in the outer one
+SUBSET_PAIRS = (("i-contours", "o-contours"),)
+
+REPORT_FIELDS = ("filename", "valid", "shapes_match", "empty_masks", "subset_violations", "error")
+
+
+def _new_record(filename, error=""):
+    return {"filename": filename, "valid": not error, "shapes_match": not error,
+        "empty_masks": "", "subset_violations": 0, "error": error}
+
+
+def _count_subset_violations(inner, outer):
+    """Return the number of inner pixels outside outer for each sample of the stacks"""
+    return np.count_nonzero((inner & ~outer).reshape(len(inner), -1), axis=1)
+
+
+def _empty_masks(masks):
+    """Return True for each sample of the stack without any mask pixel"""
+    return ~masks.reshape(len(masks), -1).any(axis=1)
+
+
+def _finish_records(records):
+    for record in records:
+        record["valid"] = (not record["error"] and record["shapes_match"]
+            and not record["empty_masks"] and record["subset_violations"] == 0)
+    return records
+
+
+def validate_stacks(filenames, datasets, present=None, subset_pairs=SUBSET_PAIRS):
+    """Validate stacked samples, as read from a packed or npy store
+
+    :param filenames: Name of each sample
+    :param datasets: Dictionary of channel -> (n_samples, height, width) array
+    :param present: Dictionary of channel -> boolean array of the samples having
+        the channel.  Default to None (all samples have every channel)
+    :return: List of report records, one per sample
+    """
+    n_samples = len(filenames)
+    if present is None:
+        present = {key: np.ones(n_samples, dtype=bool) for key in datasets}
+    records = [_new_record(filename) for filename in filenames]
+
+    for key, data in datasets.items():
+        if data.dtype != bool:
+            continue
+        for idx in np.flatnonzero(_empty_masks(data) & present[key]):
+            records[idx]["empty_masks"] = ";".join(filter(None, [records[idx]["empty_masks"], key]))
+
+    for inner_key, outer_key in subset_pairs:
+        if inner_key not in datasets or outer_key not in datasets:
+            continue
+        both = present[inner_key] & present[outer_key]
+        violations = _count_subset_violations(datasets[inner_key] != 0, datasets[outer_key] != 0)
+        for idx in np.flatnonzero(both & (violations > 0)):
+            records[idx]["subset_violations"] += int(violations[idx])
+    return _finish_records(records)
+
+
+def validate_samples(samples, subset_pairs=SUBSET_PAIRS):
+    """Validate samples of possibly different shapes, stacking them by channel and shape
+
+    :param samples: List of (filename, datasets) pairs
+    :return: List of report records, one per sample
+    """
+    records = [_new_record(filename) for filename, _ in samples]
+    groups = {}
+    for idx, (_, datasets) in enumerate(samples):
+        if not datasets:
+            records[idx]["error"] = "Empty dataset"
+            continue
+        if len(set(data.shape for data in datasets.values())) > 1:
+            records[idx]["shapes_match"] = False
+            continue
+        shape = next(iter(datasets.values())).shape
+        keys = tuple(sorted(datasets))
+        groups.setdefault((keys, shape), []).append(idx)
+
+    for (keys, _), idxs in groups.items():
+        stacked = {key: np.stack([samples[idx][1][key] for idx in idxs]) for key in keys}
+        group_records = validate_stacks([records[idx]["filename"] for idx in idxs], stacked,
+            subset_pairs=subset_pairs)
+        for idx, record in zip(idxs, group_records):
+            records[idx] = record
+    return _finish_records(records)
+
+
+def _validate_files(filenames, subset_pairs=SUBSET_PAIRS):
+    """Load and validate a chunk of HDF5 files, returning the records in the filenames order"""
+    records = [None] * len(filenames)
+    samples, sample_idxs = [], []
+    for idx, filename in enumerate(filenames):
+        try:
+            samples.append((filename, load_dataset(filename)[0]))
+            sample_idxs.append(idx)
+        except InvalidDatasetError as e:
+            records[idx] = _finish_records([_new_record(filename, str(e))])[0]
+    for idx, record in zip(sample_idxs, validate_samples(samples, subset_pairs)):
+        records[idx] = record
+    return records
+
+
+def _validate_folder(folder, workers, chunk_size, subset_pairs):
+    filenames = sorted(glob(os.path.join(folder, "*.h5")))
+    chunks = [filenames[start:start + chunk_size] for start in range(0, len(filenames), chunk_size)]
+    records = []
+    if workers and workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for chunk_records in pool.map(_validate_files, chunks, [subset_pairs] * len(chunks)):
+                records.extend(chunk_records)
+    else:
+        for chunk in chunks:
+            records.extend(_validate_files(chunk, subset_pairs))
+    return records
+
+
+def _validate_store(path, chunk_size, subset_pairs):
+    store = open_store(path)
+    records = []
+    try:
+        for start in range(0, len(store), chunk_size):
+            indices = np.arange(start, min(start + chunk_size, len(store)))
+            datasets, present = store.read(indices)
+            records.extend(validate_stacks([store.sample_name(idx) for idx in indices],
+                datasets, present, subset_pairs))
+    finally:
+        store.close()
+    return records
+
+
+def write_report(records, filename):
+    """Write the validation records as a CSV file"""
+    with open(filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+
+
+def validate_dataset(path, report_filename=None, workers=None, chunk_size=256,
+        subset_pairs=SUBSET_PAIRS):
+    """Validate a processed dataset and optionally write a per-sample CSV report
+
+    Checks that the channels of each sample have the same shape, that the masks
+    aren't empty and that the inner masks of subset_pairs are contained in the
+    outer ones (counting the violating pixels).  Samples are validated chunk_size
+    at a time with vectorized reductions over the stacked masks.
+
+    :param path: Folder of HDF5 files written by save_datasets, or a packed / npy store
+    :param report_filename: CSV report filename.  Default to None (no report)
+    :param workers: Number of processes validating the HDF5 files.  Default to None
+    :return: List of report records with the REPORT_FIELDS keys
+    """
+    is_h5_folder = os.path.isdir(path) and not os.path.isfile(os.path.join(path, NPY_INDEX_FILENAME))
+    if is_h5_folder:
+        records = _validate_folder(path, workers, chunk_size, subset_pairs)
+    else:
+        records = _validate_store(path, chunk_size, subset_pairs)
+    if report_filename:
+        write_report(records, report_filename)
+    return records
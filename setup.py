@@ -10,7 +10,7 @@ requirements = [
     # TODO: Add package version requirements here
     "pydicom",
     "pillow",
-    "numpy"
+    "numpy>=1.15"
 ]
 
 setup(
@@ -28,6 +28,7 @@ setup(
                  'contours_processor'},
     include_package_data=True,
     install_requires=requirements,
+    python_requires='>=3.7',
     license="MIT license",
     zip_safe=False,
     keywords='contours_processor',
@@ -36,10 +37,8 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
-        "Programming Language :: Python :: 2",
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
     ]
 )